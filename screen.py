@@ -18,28 +18,215 @@ import pygame                 # To create the UI
 from pygame.locals import *   # For various pygame things
 import threading              # Some functions need to run threaded
 import time                   # For sleeping and the clock
-import pylast                 # To connect to Last.fm
 import json                   # To read/write preferences
-import urllib                 # To fetch album covers
-import RPi.GPIO as GPIO       # To access tac button presses
-import websocket              # To connect to PB
-import requests               # To fetch PB pushes
+import urllib2                # To fetch album covers
+try:
+  import RPi.GPIO as GPIO     # To access tac button presses
+except ImportError:
+  GPIO = None                 # Not on a Pi; only the Headless backend works
 import base64
+import collections            # For the text surface cache
+import hashlib                # To name cached covers
+import Queue                  # To hand work to background threads
+import random                 # To jitter polling intervals
+import io                     # To decode notification icons in memory
+import atexit                 # To save pending preferences on exit
+import sqlite3                # To store the scrobble history
+import mmap                   # To map the notification history file
+import struct                 # To pack notification history records
+import bisect                 # To look up notifications by time
+import sys                    # For command line options
+import tempfile               # For the headless backend's scratch files
+import ctypes                 # To copy frames into the mapped framebuffer
+import fcntl                  # To read the touchscreen's axis ranges
+import stat                   # To tell a framebuffer device from a file
+import gc                     # To count allocations when benchmarking
+import signal                 # To start the profiler on SIGUSR1
+import contextlib             # For timed()
+
+# LazyModule stands in for a module that's slow to import and isn't needed
+# to put the clock up.  The module is imported the first time anything
+# in it is used (normally by the threads connecting to Last.fm and
+# Pushbullet at startup), and then replaces its LazyModule as a global.
+
+class LazyModule:
+  def __init__(self, name):
+    self.__dict__['name'] = name
+
+  def __getattr__(self, attr):
+    module = __import__(self.name)
+    globals()[self.name] = module
+    return getattr(module, attr)
+
+pylast    = LazyModule('pylast')    # To connect to Last.fm
+websocket = LazyModule('websocket') # To connect to PB
+requests  = LazyModule('requests')  # To fetch PB pushes
+numpy     = LazyModule('numpy')     # To process album covers
 
 # UI classes ---------------------------------------------------------------
 
 # Icon is a very simple bitmap class, just associates a name and a pygame
-# image (PNG loaded from icons directory) for each.
-# There isn't a globally-declared fixed list of Icons.  Instead, the list
+# image (PNG loaded from icons directory) for each.  The image is converted
+# to the display's pixel format once at load, so blitting it later doesn't
+# have to convert every pixel again.
+# There isn't a globally-declared fixed list of Icons.  Instead, Assets
 # is populated at runtime from the contents of the 'icons' directory.
 
 class Icon:
 	def __init__(self, name):
 	  self.name = name
 	  try:
-	    self.bitmap = pygame.image.load(iconPath + '/' + name + '.png')
+	    self.bitmap = convertBitmap(
+	      pygame.image.load(iconPath + '/' + name + '.png'))
 	  except:
-	    pass
+	    self.bitmap = None
+
+# Assets holds every Icon by name, so lookups (Button icons, screen
+# backgrounds and logos) are a dict access rather than a scan of a list
+# or a fresh pygame.image.load().  load() must be called after the
+# display mode has been set, as the bitmaps are converted to match it.
+
+class Assets:
+  def __init__(self, path):
+    self.path  = path
+    self.icons = {}
+
+  def load(self):
+    for file in os.listdir(self.path):
+      if fnmatch.fnmatch(file, '*.png'):
+        name = file.split('.')[0]
+        self.icons[name] = Icon(name)
+
+  def get(self, name):
+    return self.icons.get(name)
+
+  def bitmap(self, name):
+    return self.icons[name].bitmap
+
+# Fonts opens each face/size once and hands out the same Font object from
+# then on.  Faces ending in .ttf are loaded from file, anything else is
+# looked up with SysFont (which scans the system fonts, so it's worth only
+# doing once).
+
+class Fonts:
+  def __init__(self):
+    self.fonts = {}
+
+  def get(self, face, size):
+    font = self.fonts.get((face, size))
+    if font is None:
+      if face.endswith(".ttf"):
+        font = pygame.font.Font(face, size)
+      else:
+        font = pygame.font.SysFont(face, size)
+      self.fonts[(face, size)] = font
+    return font
+
+# TextCache is a least-recently-used cache of rendered text surfaces,
+# keyed by (font, text, color).  Once the surfaces held add up to more
+# than limit bytes the oldest ones are dropped.  hits, misses and
+# evictions are counted, as metrics, for tuning the limit.
+
+class TextCache:
+  def __init__(self, limit=512*1024):
+    self.surfaces  = collections.OrderedDict()
+    self.limit     = limit # Memory cap, in bytes of pixel data
+    self.bytes     = 0     # Pixel data currently held
+    self.hits      = metrics.counter('text_cache_hits_total', "Text renders found in the cache")
+    self.misses    = metrics.counter('text_cache_misses_total', "Text renders not in the cache")
+    self.evictions = metrics.counter('text_cache_evictions_total',
+                                     "Text surfaces dropped to keep the cache under its limit")
+
+  def render(self, font, text, color=(255,255,255)):
+    key     = (font, text, tuple(color))
+    surface = self.surfaces.pop(key, None)
+    if surface is not None:
+      self.hits.inc()
+      self.surfaces[key] = surface # Re-insert as most recently used
+      return surface
+    self.misses.inc()
+    surface = font.render(text, 1, color)
+    self.surfaces[key] = surface
+    self.bytes += surfaceBytes(surface)
+    while self.bytes > self.limit and len(self.surfaces) > 1:
+      key, old = self.surfaces.popitem(last=False)
+      self.bytes -= surfaceBytes(old)
+      self.evictions.inc()
+    return surface
+
+# GlyphAtlas renders each character of a font once, so text made from a
+# small alphabet (the HH:MM clock) can be composed by blitting cached
+# glyphs rather than rendering the whole string every time it changes.
+
+class GlyphAtlas:
+  def __init__(self, font, color=(255,255,255)):
+    self.font   = font
+    self.color  = color
+    self.glyphs = {}
+
+  def glyph(self, ch):
+    g = self.glyphs.get(ch)
+    if g is None:
+      g = self.font.render(ch, 1, self.color)
+      self.glyphs[ch] = g
+    return g
+
+  def size(self, text):
+    w = h = 0
+    for ch in text:
+      g  = self.glyph(ch)
+      w += g.get_width()
+      h  = max(h, g.get_height())
+    return (w, h)
+
+  def draw(self, screen, text, pos):
+    x, y = pos
+    for ch in text:
+      g = self.glyph(ch)
+      screen.blit(g, (x, y))
+      x += g.get_width()
+
+# Widget is the base of the retained scene.  Each has a bounding rect and
+# a state() describing what it currently shows.  The Renderer compares
+# state() against the state it last drew; only when they differ is
+# update() called (to re-render content and recompute the rect) and the
+# old and new rects redrawn.  Static widgets (Buttons, Images, Labels of
+# fixed text) are composed into their Scene's background layer instead
+# of being drawn every frame; their state() only changes when the layer
+# needs composing again.
+
+class Widget:
+  static = False
+
+  def __init__(self, rect):
+    self.rect  = pygame.Rect(rect) # Bounds as last laid out
+    self.drawn = Widget            # State as last drawn (Widget = never)
+
+  def state(self):
+    return None
+
+  def update(self, state):
+    pass
+
+  def draw(self, screen):
+    pass
+
+  # When the widget next changes on its own (the clock turning over, a
+  # marquee's next step), or None if it only changes with the app state
+  def due(self, now):
+    return None
+
+  # Bring the widget up to date; returns the list of rects that need to
+  # be redrawn (empty if nothing changed).
+  def refresh(self, force=False):
+    state = self.state()
+    if not force and state == self.drawn:
+      return []
+    old = pygame.Rect(self.rect)
+    self.update(state)
+    self.drawn = state
+    return [old, self.rect]
+
 # Button is a simple tappable screen region.  Each has:
 #  - bounding rect ((X,Y,W,H) in pixels)
 #  - optional background color and/or Icon (or None), always centered
@@ -56,9 +243,11 @@ class Icon:
 # After Icons are loaded at runtime, a pass is made through the global
 # buttons[] list to assign the Icon objects (from names) to each Button.
 
-class Button:
+class Button(Widget):
+	static = True
+
 	def __init__(self, rect, **kwargs):
-	  self.rect     = rect # Bounds
+	  Widget.__init__(self, rect) # Bounds
 	  self.color    = None # Background fill color, if any
 	  self.iconBg   = None # Background Icon (atop color fill)
 	  self.iconFg   = None # Foreground Icon (atop background)
@@ -73,16 +262,25 @@ class Button:
 	    elif key == 'cb'   : self.callback = value
 	    elif key == 'value': self.value    = value
 
-	def selected(self, pos):
+	def state(self):
+	  return (self.color, self.iconBg, self.iconFg)
+
+	def contains(self, pos):
 	  x1 = self.rect[0]
 	  y1 = self.rect[1]
 	  x2 = x1 + self.rect[2] - 1
 	  y2 = y1 + self.rect[3] - 1
-	  if ((pos[0] >= x1) and (pos[0] <= x2) and
-	      (pos[1] >= y1) and (pos[1] <= y2)):
-	    if self.callback:
-	      if self.value is None: self.callback()
-	      else:                  self.callback(self.value)
+	  return ((pos[0] >= x1) and (pos[0] <= x2) and
+	          (pos[1] >= y1) and (pos[1] <= y2))
+
+	def press(self):
+	  if self.callback:
+	    if self.value is None: self.callback()
+	    else:                  self.callback(self.value)
+
+	def selected(self, pos):
+	  if self.contains(pos):
+	    self.press()
 	    return True
 	  return False
 
@@ -102,27 +300,2239 @@ class Button:
 	  if name is None:
 	    self.iconBg = None
 	  else:
-	    for i in icons:
-	      if name == i.name:
-	        self.iconBg = i
-	        break
+	    i = assets.get(name)
+	    if i: self.iconBg = i
+
+# HitGrid finds the Button under a tap without checking every Button on
+# the screen.  The screen is divided into cell x cell squares, and each
+# square lists the Buttons overlapping it in their stacking order, so the
+# first Button in the list still takes precedence.  hit() only finds the
+# Button; pressing it is up to the caller.  Call rebuild() whenever a
+# screen's list of Buttons changes.
+
+class HitGrid:
+  def __init__(self, buttons, size=(320, 240), cell=40):
+    self.size = size
+    self.cell = cell
+    self.cols = (size[0] + cell - 1) // cell
+    self.rows = (size[1] + cell - 1) // cell
+    self.rebuild(buttons)
+
+  def rebuild(self, buttons):
+    self.buttons = buttons
+    self.cells   = [[] for i in range(self.cols * self.rows)]
+    bounds       = pygame.Rect((0, 0), self.size)
+    for b in buttons:
+      r = b.rect.clip(bounds)
+      if r.w == 0 or r.h == 0: continue
+      for row in range(r.top // self.cell, (r.bottom - 1) // self.cell + 1):
+        for col in range(r.left // self.cell, (r.right - 1) // self.cell + 1):
+          self.cells[row * self.cols + col].append(b)
+
+  def hit(self, pos):
+    x, y = pos
+    if x < 0 or y < 0 or x >= self.size[0] or y >= self.size[1]:
+      return None
+    for b in self.cells[(y // self.cell) * self.cols + x // self.cell]:
+      if b.contains(pos):
+        return b
+    return None
+
+# Label is a single line of white text.  text may be a string or a
+# function returning one (e.g. lambda: app.track.artist), so it redraws
+# itself only when the text it shows actually changes.  pos is the
+# top-left corner, or the center point if center is True.
+
+class Label(Widget):
+  def __init__(self, pos, text, size=20, face="Arial", center=False):
+    Widget.__init__(self, (pos[0], pos[1], 0, 0))
+    self.pos     = pos
+    self.text    = text
+    self.size    = size
+    self.face    = face
+    self.center  = center
+    self.surface = None
+    self.static  = not callable(text)
+
+  def state(self):
+    if callable(self.text): return self.text()
+    return self.text
+
+  def update(self, text):
+    self.surface = textCache.render(fonts.get(self.face, self.size), text)
+    self.rect    = self.surface.get_rect()
+    if self.center: self.rect.center  = self.pos
+    else:           self.rect.topleft = self.pos
+
+  def draw(self, screen):
+    screen.blit(self.surface, self.rect)
+
+# Marquee is a Label confined to a box.  Text that fits is drawn as is;
+# longer text holds still for hold seconds, then scrolls left at speed
+# pixels per second, stepping fps times a second.  The text is rendered
+# once, twice over with a gap between, into a strip, and each step just
+# blits a box-sized window of the strip from further along, wrapping
+# round to the start.
+
+class Marquee(Widget):
+  def __init__(self, rect, text, size=20, face="Arial",
+               speed=30, fps=15, hold=2, gap=40):
+    Widget.__init__(self, rect)
+    self.text   = text
+    self.size   = size
+    self.face   = face
+    self.speed  = speed
+    self.fps    = fps
+    self.hold   = hold
+    self.gap    = gap
+    self.shown  = None  # Text being shown
+    self.since  = 0     # When it was first shown
+    self.period = 0     # Pixels per full scroll, 0 if it fits
+    self.strip  = None
+
+  def state(self):
+    text = self.text() if callable(self.text) else self.text
+    if text != self.shown:
+      self.shown  = text
+      self.since  = app.now
+      width       = fonts.get(self.face, self.size).size(text)[0]
+      self.period = width + self.gap if width > self.rect.w else 0
+    return (text, self.offset(app.now))
+
+  def offset(self, now):
+    if not self.period: return 0
+    return self.steps(now) * self.speed // self.fps % self.period
+
+  # Steps scrolled by now (the small allowance stops a wake-up at a step's
+  # due time rounding down to the step before)
+  def steps(self, now):
+    return max(int((now - self.since - self.hold) * self.fps + 0.001), 0)
+
+  def update(self, state):
+    text, offset = state
+    if self.strip is not None and self.drawn is not Widget and self.drawn[0] == text:
+      return
+    surface = textCache.render(fonts.get(self.face, self.size), text)
+    if not self.period:
+      self.strip = surface
+      return
+    self.strip = pygame.Surface((self.period + surface.get_width(),
+                                 surface.get_height()), SRCALPHA, 32)
+    self.strip.blit(surface, (0, 0))
+    self.strip.blit(surface, (self.period, 0))
+
+  def draw(self, screen):
+    screen.blit(self.strip, self.rect.topleft,
+                (self.drawn[1], 0, self.rect.w, self.rect.h))
+
+  def due(self, now):
+    if not self.period: return None
+    start = self.since + self.hold
+    if now < start: return start
+    return start + (self.steps(now) + 1) / float(self.fps)
+
+# Image is a static bitmap from Assets.
+
+class Image(Widget):
+  static = True
+
+  def __init__(self, pos, name):
+    Widget.__init__(self, (pos[0], pos[1], 0, 0))
+    self.name   = name
+    self.bitmap = None
+
+  def update(self, state):
+    self.bitmap = assets.bitmap(self.name)
+    self.rect.size = self.bitmap.get_size()
+
+  def draw(self, screen):
+    screen.blit(self.bitmap, self.rect)
+
+# Cover is the album art on the Now Playing screen.  It asks the
+# CoverFetcher for the current cover URL and shows a placeholder until
+# the fetcher has it ready; it never waits on the network itself.
+
+class Cover(Widget):
+  def __init__(self, rect, url):
+    Widget.__init__(self, rect)
+    self.url    = url
+    self.bitmap = None
+
+  def state(self):
+    url = self.url()
+    if not url: return (url, None)
+    return (url, covers.get(url))
+
+  def update(self, state):
+    self.bitmap = state[1]
+
+  def draw(self, screen):
+    if self.bitmap:
+      screen.blit(self.bitmap, self.rect)
+    elif self.drawn[0]:
+      screen.fill((40,40,40), self.rect) # Placeholder while fetching
+
+# CoverFetcher downloads album covers on its own thread.  Each URL is
+# fetched once and stored under path, named by a hash of the URL; once
+# the files there add up to more than maxBytes the least recently used
+# are deleted.  Each cover is then processed once, on the same thread:
+# scaled to size by area averaging and dithered to RGB565, and made into
+# a blurred backdrop of backdropSize.  Both are kept in memory for the
+# last keep URLs.  get() returns the scaled cover, or None (after queueing a fetch)
+# if it isn't ready yet; backdrop() returns the backdrop once get() has
+# the cover.  A download that takes more than timeout seconds, or that
+# isn't an image (an HTTP error, say), fails and isn't cached; a URL that
+# fails isn't retried for retry seconds.
+
+class CoverFetcher:
+  def __init__(self, path="cache/covers", size=(115, 115), backdropSize=(320, 240),
+               maxBytes=4*1024*1024, keep=8, retry=300, timeout=10):
+    self.path         = path
+    self.size         = size
+    self.backdropSize = backdropSize
+    self.maxBytes     = maxBytes
+    self.keep         = keep
+    self.retry        = retry
+    self.timeout      = timeout
+    self.covers       = collections.OrderedDict() # URL -> (cover, backdrop)
+    self.pending      = set()
+    self.failed       = {}                        # URL -> time of failure
+    self.queue        = Queue.Queue()
+    self.lock         = threading.Lock()
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def get(self, url):
+    with self.lock:
+      art = self.covers.pop(url, None)
+      if art is not None:
+        self.covers[url] = art # Re-insert as most recently used
+        return art[0]
+      if url in self.pending:
+        return None
+      if time.time() - self.failed.get(url, 0) < self.retry:
+        return None
+      self.pending.add(url)
+    self.queue.put(url)
+    return None
+
+  def backdrop(self, url):
+    with self.lock:
+      art = self.covers.get(url)
+    return art[1] if art else None
+
+  def run(self):
+    while True:
+      url = self.queue.get()
+      try:
+        art = self.load(url)
+      except Exception as e:
+        log("Failed to fetch cover " + url + ": " + str(e), "ERROR")
+        art = None
+      with self.lock:
+        self.pending.discard(url)
+        if art is None:
+          self.failed[url] = time.time()
+        else:
+          self.failed.pop(url, None)
+          self.covers[url] = art
+          while len(self.covers) > self.keep:
+            self.covers.popitem(last=False)
+      if art is not None:
+        wake()
+
+  # Fetch url into the disk cache unless it's already there, then decode
+  # and process it
+  def load(self, url):
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+    ext  = os.path.splitext(url.split('?')[0])[1] or '.png'
+    file = os.path.join(self.path, hashlib.sha1(url).hexdigest() + ext)
+    if os.path.exists(file):
+      os.utime(file, None) # Mark as recently used
+      try:
+        return self.process(pygame.image.load(file))
+      except pygame.error:
+        os.remove(file) # Fetch it again next time
+        raise
+    response = urllib2.urlopen(url, timeout=self.timeout) # Raises on HTTP errors
+    try:
+      data = response.read()
+    finally:
+      response.close()
+    bitmap = pygame.image.load(io.BytesIO(data), ext) # Only an image is cached
+    with open(file + '.tmp', 'wb') as outfile:
+      outfile.write(data)
+    os.rename(file + '.tmp', file)
+    self.trim()
+    return self.process(bitmap)
+
+  # The scaled cover and backdrop surfaces for a decoded cover
+  def process(self, bitmap):
+    import pygame.surfarray # Imports numpy, so not until the first cover
+    pixels   = pygame.surfarray.array3d(bitmap).astype(float)
+    cover    = ditherRGB565(areaScale(pixels, self.size))
+    backdrop = coverBackdrop(pixels, self.backdropSize)
+    return (pygame.surfarray.make_surface(cover).convert(),
+            pygame.surfarray.make_surface(backdrop).convert())
+
+  # Delete the least recently used covers until the cache fits maxBytes
+  def trim(self):
+    files = []
+    for name in os.listdir(self.path):
+      st = os.stat(os.path.join(self.path, name))
+      files.append((st.st_mtime, st.st_size, name))
+    files.sort()
+    total = sum(f[1] for f in files)
+    while total > self.maxBytes and len(files) > 1:
+      mtime, size, name = files.pop(0)
+      os.remove(os.path.join(self.path, name))
+      total -= size
+
+# Backdrop fills the screen behind a Scene with the blurred cover the
+# CoverFetcher made for the current track, or the named Icon until there
+# is one.  It's static, so it's part of the Scene's layer, which is only
+# composed again when the backdrop changes.
+
+class Backdrop(Widget):
+  static = True
+
+  def __init__(self, url, name):
+    Widget.__init__(self, (0, 0, 0, 0))
+    self.url    = url
+    self.name   = name
+    self.bitmap = None
+
+  def state(self):
+    url = self.url()
+    return (url, covers.backdrop(url) if url else None)
+
+  def update(self, state):
+    self.bitmap = state[1] or assets.bitmap(self.name)
+    self.rect.size = self.bitmap.get_size()
+
+  def draw(self, screen):
+    screen.blit(self.bitmap, self.rect)
+
+# ClockFace is the big HH:MM clock with the AM/PM marker to its right,
+# centered on the screen.  It only changes once a minute, and the digits
+# are composed from a GlyphAtlas rather than rendered as a string.  It
+# shows the time of the AppState (app.now), so replays draw replayed time.
+
+class ClockFace(Widget):
+  def __init__(self):
+    Widget.__init__(self, (0, 0, 0, 0))
+    self.atlas = None
+
+  def state(self):
+    return time.strftime("%H:%M %p", time.localtime(app.now))
+
+  def update(self, state):
+    if self.atlas is None:
+      self.atlas = GlyphAtlas(fonts.get("SFDigitalReadout-Medium.ttf", 120))
+    self.mytime, myp    = state.split(" ")
+    self.plabel         = textCache.render(fonts.get("Arial", 30), myp)
+    self.textpos        = pygame.Rect((0, 0), self.atlas.size(self.mytime))
+    self.textpos.center = (160, 120)
+    self.ppos           = self.plabel.get_rect(
+      topleft=(self.textpos[0] + self.textpos[2] + 10, self.textpos[1]))
+    self.rect           = self.textpos.union(self.ppos)
+
+  def draw(self, screen):
+    screen.blit(self.plabel, self.ppos)
+    self.atlas.draw(screen, self.mytime, self.textpos.topleft)
+
+  def due(self, now):
+    return (now // 60 + 1) * 60
+
+# NotificationPanel is an overlay along the bottom of the screen showing
+# the Pushbullet push or mirrored notification in app.notice, while the
+# screen underneath keeps updating.
+
+class NotificationPanel(Widget):
+  def __init__(self):
+    Widget.__init__(self, (0, 120, 320, 120))
+
+  def state(self):
+    return app.notice
+
+  def update(self, notification):
+    self.labels = []
+    if notification is None: return
+    myfont = fonts.get("Arial", 20)
+    x, y   = self.rect.left + 10, self.rect.top + 36
+    lines  = (self.rect.bottom - y) // 20
+    if notification.kind == "push":
+      # Title and URL get a line each (ellipsized), the body wraps to fill
+      # the lines left over
+      data  = notification.data
+      self.header(myfont, notification, "New " + data.get('type', "push") +
+                  self.sender(data) + self.target(data))
+      width = self.rect.w - 20
+      title = [fitText(myfont, data['title'], width)] if data.get('title') else []
+      url   = [fitText(myfont, data['url'],   width)] if data.get('url')   else []
+      body  = wrapText(myfont, data.get('body') or "", width,
+                       lines - len(title) - len(url))
+      for line in title + body + url:
+        self.labels.append((textCache.render(myfont, line), (x, y)))
+        y += 20
+    else:
+      self.header(myfont, notification, "New Notification!")
+      if notification.data.get('bitmap'):
+        self.labels.append((notification.data['bitmap'], (x, y)))
+      for line in wrapText(myfont, notification.data.get('title', ''), self.rect.w - 92, lines):
+        self.labels.append((textCache.render(myfont, line), (x + 82, y)))
+        y += 20
+
+  # The header line, ellipsized to leave room for the count of coalesced
+  # notifications
+  def header(self, myfont, notification, text):
+    more = ""
+    if notification.count > 1:
+      more = " (+" + str(notification.count - 1) + " more)"
+    text = fitText(myfont, text, self.rect.w - 55 - myfont.size(more)[0]) + more
+    self.labels.append((assets.bitmap('pb'), (self.rect.left + 10, self.rect.top + 6)))
+    self.labels.append((textCache.render(myfont, text), (self.rect.left + 45, self.rect.top + 8)))
+
+  # " from <sender>" for a push someone sent
+  def sender(self, push):
+    sender = push.get('sender_email_normalized') or push.get('sender_name')
+    return " from " + sender if sender else ""
+
+  # " (To <device>)" for a push sent to a particular device
+  def target(self, push):
+    if 'target_device_iden' in push:
+      for device in (pushbullet and pushbullet.devices) or []:
+        if device['iden'] == push['target_device_iden']:
+          if 'nickname' in device:
+            return " (To " + device['nickname'] + ")"
+          elif 'model' in device:
+            return " (To " + device['model'] + ")"
+    return ""
+
+  def draw(self, screen):
+    if self.drawn is None: return
+    screen.fill((30,30,30), self.rect)
+    screen.fill((90,90,90), (self.rect.left, self.rect.top, self.rect.w, 2))
+    for label, pos in self.labels:
+      screen.blit(label, pos)
+
+# PagedList shows one page of a history, rows lines tall and newest
+# first, each line a time and some text.  page() returns the page number
+# shown and anything else that, changing, means the page needs reading
+# again (a version); fetch(offset, count) returns the (time, text) lines.
+# Pages are only read when that changes.
+
+class PagedList(Widget):
+  def __init__(self, rect, page, fetch, rows=4):
+    Widget.__init__(self, rect)
+    self.page   = page
+    self.fetch  = fetch
+    self.rows   = rows
+    self.labels = []
+
+  def state(self):
+    return self.page()
+
+  def update(self, state):
+    myfont = fonts.get("Arial", 20)
+    height = self.rect.h // self.rows
+    lines  = self.fetch(state[0] * self.rows, self.rows)
+    self.labels = []
+    if not lines:
+      self.labels.append((textCache.render(myfont, "Nothing yet"),
+                          (self.rect.left + 10, self.rect.top + 6)))
+    for i, (when, text) in enumerate(lines):
+      y    = self.rect.top + i * height + (height - 20) // 2
+      when = time.strftime("%H:%M", time.localtime(when))
+      text = fitText(myfont, text, self.rect.w - 75)
+      self.labels.append((textCache.render(myfont, when), (self.rect.left + 10, y)))
+      self.labels.append((textCache.render(myfont, text), (self.rect.left + 65, y)))
+
+  def draw(self, screen):
+    for label, pos in self.labels:
+      screen.blit(label, pos)
+
+# Scene is the retained list of Widgets making up one screen mode, in
+# drawing order (Buttons first, then the mode's content).  The static
+# widgets are composed once into layer, a display-format surface, which
+# background() composes again only when one of their states changes
+# (an Icon being swapped, say).  Dynamic widgets are always drawn atop
+# the layer, whatever their place in the list.
+
+class Scene:
+  def __init__(self, widgets):
+    self.widgets = widgets
+    self.static  = [w for w in widgets if w.static]
+    self.dynamic = [w for w in widgets if not w.static]
+    self.layer   = None
+    self.key     = None # States of the static widgets as composed
+
+  # Returns True if the layer was composed (again)
+  def background(self, size):
+    key = [w.state() for w in self.static]
+    if self.layer is not None and key == self.key:
+      return False
+    if self.layer is None:
+      self.layer = pygame.Surface(size).convert()
+    self.layer.fill(0)
+    for w in self.static:
+      w.refresh(True)
+      w.draw(self.layer)
+    self.key = key
+    return True
+
+# Renderer pushes Scenes to the display, with the overlays Widgets drawn
+# atop every Scene.  Switching scenes, a change to the Scene's background
+# layer (or calling invalidate()) redraws the whole screen; otherwise
+# only the rects of dynamic Widgets whose state changed are restored from
+# the layer, redrawn (along with whatever overlaps them, in stacking
+# order) and passed to update (the backend's, normally
+# display.update()).  dirtyRects and dirtyPixels hold the cost of the
+# most recent frame.
+
+class Renderer:
+  def __init__(self, screen, overlays=None, update=pygame.display.update):
+    self.screen      = screen
+    self.overlays    = overlays or []
+    self.update      = update
+    self.scene       = None
+    self.dirtyRects  = 0
+    self.dirtyPixels = 0
+    self.frameTime   = metrics.histogram('frame_ms', "Time taken to draw a frame",
+                                         [1, 2, 5, 10, 20, 50, 100, 250, float('inf')])
+    self.pixels      = metrics.counter('pixels_pushed_total', "Pixels pushed to the display")
+
+  def invalidate(self):
+    self.scene = None
+
+  def render(self, scene):
+    start   = time.time()
+    screen  = self.screen
+    bounds  = screen.get_rect()
+    widgets = scene.dynamic + self.overlays
+    if scene.background(bounds.size) or scene is not self.scene:
+      for w in widgets:
+        w.refresh(True)
+      dirty = [bounds]
+      self.scene = scene
+    else:
+      dirty = []
+      for w in widgets:
+        dirty.extend(w.refresh())
+      dirty = mergeRects(dirty, bounds)
+
+    for r in dirty:
+      screen.set_clip(r)
+      screen.blit(scene.layer, r, r)
+      for w in widgets:
+        if w.rect.colliderect(r):
+          w.draw(screen)
+    screen.set_clip(None)
+
+    if dirty:
+      self.update(dirty)
+    self.dirtyRects  = len(dirty)
+    self.dirtyPixels = sum(r.w * r.h for r in dirty)
+    self.pixels.inc(self.dirtyPixels)
+    self.frameTime.add((time.time() - start) * 1000)
+
+  # When the Widgets on screen next change on their own, or None
+  def due(self, now):
+    times = [w.due(now) for w in self.scene.dynamic + self.overlays]
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+# Scheduler puts the main loop to sleep until the next time something on
+# screen is due to change.  Each pass the loop sets deadlines by name
+# with at() (the next Widget due to change, the overlay expiring, the
+# backlight timing out; None clears one), and wait() sleeps until the
+# earliest of them or until an event (a tap, the tact switch, a wake-up
+# from a background thread) arrives, whichever is first.  With no
+# deadlines it sleeps until an event.  Wake-ups and CPU time are tallied
+# each minute into wakeups and cpu (percent of one core), and logged
+# every ten minutes.
+
+class Scheduler:
+  def __init__(self, timerEvent):
+    self.timerEvent = timerEvent
+    self.deadlines  = {}
+    self.wakeups    = 0    # Wake-ups in the last full minute
+    self.cpu        = 0.0  # CPU used in the last full minute, percent
+    self.count      = 0    # Wake-ups so far this minute
+    self.minutes    = 0
+    self.since      = time.time()
+    self.times      = os.times()
+    metrics.gauge('wakeups_per_minute', "Main loop wake-ups in the last full minute",
+                  lambda: self.wakeups)
+    metrics.gauge('cpu_percent', "CPU used in the last full minute, percent of one core",
+                  lambda: self.cpu)
+
+  def at(self, name, when):
+    if when is None: self.deadlines.pop(name, None)
+    else:            self.deadlines[name] = when
+
+  def wait(self, dispatcher):
+    if self.deadlines:
+      delay = min(self.deadlines.values()) - time.time()
+      pygame.time.set_timer(self.timerEvent, max(1, int(delay * 1000) + 1))
+    events = dispatcher.wait()
+    pygame.time.set_timer(self.timerEvent, 0)
+    self.tally()
+    return events
+
+  def tally(self):
+    self.count += 1
+    now = time.time()
+    if now - self.since < 60: return
+    times        = os.times()
+    used         = (times[0] + times[1]) - (self.times[0] + self.times[1])
+    self.cpu     = 100.0 * used / (now - self.since)
+    self.wakeups = self.count
+    self.count   = 0
+    self.since   = now
+    self.times   = times
+    self.minutes += 1
+    if self.minutes % 10 == 0:
+      log("%d wake-ups/minute, %.1f%% CPU" % (self.wakeups, self.cpu), "INFO")
+
+# Histogram counts observations into fixed buckets (upper bounds, the
+# last of which should be float('inf')), e.g. milliseconds of latency.
+
+class Histogram:
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * len(bounds)
+    self.count  = 0
+    self.sum    = 0.0
+
+  def add(self, value):
+    for i, bound in enumerate(self.bounds):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.sum   += value
+
+  def summary(self):
+    buckets = ["<=%g:%d" % (b, c) for b, c in zip(self.bounds, self.counts)]
+    return "n=%d avg=%.1f %s" % (self.count, self.sum / max(self.count, 1),
+                                 " ".join(buckets))
+
+# StartupTimer times startup stage by stage.  mark() ends a stage on the
+# main thread, each timed from the end of the last, and done() logs them
+# along with the time from the process starting (see processStart()) to
+# the first frame, noted by frame().  background() runs a stage on its
+# own thread, logging how long it took once it's finished.
+
+class StartupTimer:
+  def __init__(self):
+    self.start      = processStart()
+    self.last       = time.time()
+    self.stages     = []   # (name, seconds)
+    self.firstFrame = None # Seconds from the process starting
+
+  def mark(self, name):
+    now = time.time()
+    self.stages.append((name, now - self.last))
+    self.last = now
+
+  def frame(self):
+    self.firstFrame = time.time() - self.start
+
+  def done(self):
+    log("Startup: first frame %.2fs after start, main thread done after %.2fs (%s)" %
+        (self.firstFrame or 0, time.time() - self.start,
+         ", ".join("%s %.2fs" % stage for stage in self.stages)), "INFO")
+
+  def background(self, name, target):
+    thread = threading.Thread(target=self.run, args=(name, target))
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self, name, target):
+    start = time.time()
+    try:
+      target()
+    except Exception as e:
+      log("Startup: " + name + " failed: " + str(e), "ERROR")
+      return
+    log("Startup: %s ready in %.2fs, %.2fs after start" %
+        (name, time.time() - start, time.time() - self.start), "INFO")
+
+# Metrics is a registry of counters, gauges and Histograms, exported in
+# the Prometheus text format by text().  Each is registered by name (and
+# any labels, as keyword arguments) the first time it's asked for, and
+# asking again returns the same one, so callers look theirs up once and
+# keep it.  A counter or gauge can be given fn instead, to read its value
+# from elsewhere when exported.  Updates take no locks, to stay cheap on
+# hot paths; a count bumped from two threads at the same instant can very
+# occasionally be lost, which is fine for this.
+
+class Counter:
+  def __init__(self, fn=None):
+    self.count = 0
+    self.fn    = fn
+
+  def inc(self, n=1):
+    self.count += n
+
+  def value(self):
+    return self.fn() if self.fn else self.count
+
+class Gauge:
+  def __init__(self, fn=None):
+    self.current = 0
+    self.fn      = fn
+
+  def set(self, value):
+    self.current = value
+
+  def value(self):
+    return self.fn() if self.fn else self.current
+
+class Metrics:
+  def __init__(self, prefix='screen_'):
+    self.prefix  = prefix
+    self.metrics = {} # (name, labels) -> metric
+    self.help    = {} # name -> help text
+    self.lock    = threading.Lock()
+
+  def counter(self, name, help, fn=None, **labels):
+    return self.register(Counter, name, help, labels, fn)
+
+  def gauge(self, name, help, fn=None, **labels):
+    return self.register(Gauge, name, help, labels, fn)
+
+  def histogram(self, name, help, bounds, **labels):
+    return self.register(Histogram, name, help, labels, bounds)
+
+  def register(self, kind, name, help, labels, arg):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      metric = self.metrics.get(key)
+      if metric is None:
+        metric = self.metrics[key] = kind(arg)
+        self.help[name] = help
+    return metric
+
+  def text(self):
+    with self.lock:
+      metrics = sorted(self.metrics.items())
+    lines, previous = [], None
+    for (name, labels), metric in metrics:
+      full = self.prefix + name
+      if name != previous:
+        previous = name
+        kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[metric.__class__]
+        lines.append("# HELP %s %s" % (full, self.help[name]))
+        lines.append("# TYPE %s %s" % (full, kind))
+      if isinstance(metric, Histogram):
+        total = 0
+        for bound, count in zip(metric.bounds, metric.counts):
+          total += count
+          if bound != float('inf'):
+            lines.append("%s_bucket%s %d" % (full, labelText(labels + (('le', '%g' % bound),)), total))
+        lines.append("%s_bucket%s %d" % (full, labelText(labels + (('le', '+Inf'),)), metric.count))
+        lines.append("%s_sum%s %r" % (full, labelText(labels), float(metric.sum)))
+        lines.append("%s_count%s %d" % (full, labelText(labels), metric.count))
+      else:
+        lines.append("%s%s %r" % (full, labelText(labels), float(metric.value())))
+    return "\n".join(lines) + "\n"
+
+# InputDispatcher owns the pygame event queue, on the main thread.
+# wait() blocks until at least one event arrives (a tap, the tact switch,
+# the Scheduler's timer or a wake-up from a background thread), then runs the
+# handler registered for each queued event.  The time from an input
+# event to the end of the next frame is recorded in latency (in ms);
+# tact switch events carry the time they were posted, taps are timed
+# from when they're taken off the queue.
+
+class InputDispatcher:
+  def __init__(self):
+    self.handlers = {}
+    self.inputs   = (MOUSEBUTTONDOWN, TFTBUTTONCLICK)
+    self.pending  = [] # Times of input events not yet drawn
+    self.latency  = metrics.histogram('input_latency_ms', "Time from an input event to the frame showing it",
+                                      [10, 20, 50, 100, 200, 500, 1000, float('inf')])
+
+  def on(self, type, handler):
+    self.handlers[type] = handler
+    pygame.event.set_allowed(type)
+
+  def wait(self):
+    events = [pygame.event.wait()] + pygame.event.get()
+    for event in events:
+      if event.type in self.inputs:
+        self.pending.append(getattr(event, 't', time.time()))
+      handler = self.handlers.get(event.type)
+      if handler: handler(event)
+    return events
+
+  # Call after each frame is drawn
+  def rendered(self):
+    if not self.pending: return
+    now = time.time()
+    for t in self.pending:
+      self.latency.add((now - t) * 1000)
+    self.pending = []
+    if self.latency.count % 50 == 0:
+      log("Input latency (ms): " + self.latency.summary(), "INFO")
+
+# Backlight switches the PiTFT backlight by writing to sysfs directly,
+# with the value file held open, rather than spawning a shell per toggle.
+# Writes are skipped when the backlight is already in the requested
+# state.  GPIO pin is used as a plain on/off switch, unless the
+# 'backlight_device' setting names the PiTFT's PWM backlight (a
+# /sys/class/backlight device); that's driven through its brightness file
+# instead, fading over fade seconds to the 'brightness' setting (percent,
+# default 100).  PWM is opt-in because other displays (a DSI panel, say)
+# register backlight devices too, and fading one of those would leave the
+# PiTFT lit.  root is the sysfs class directory, so the driver can be
+# pointed at a FakeSysfs tree.
 
 class Backlight:
-  def __init__(self, config):
-    os.system("echo 508 > /sys/class/gpio/export")
-    os.system("echo 'out' > /sys/class/gpio/gpio508/direction")
-    if config['settings']['backlight'] == "on":
+  def __init__(self, config, root='/sys/class', pin=508, fade=0.25):
+    self.state   = None # True/False once set, None until then
+    self.changed = 0    # When state last changed
+    self.onTime  = 0.0  # Seconds on, up to when it last changed
+    metrics.counter('backlight_on_seconds_total', "Time the backlight has been on",
+                    lambda: self.onTime + (time.time() - self.changed if self.state else 0))
+    self.switches = metrics.counter('backlight_switches_total', "Times the backlight was switched")
+    self.config = config
+    self.fade  = fade
+    self.gen   = 0    # Bumped to cancel a running fade
+    self.lock  = threading.Lock()
+    name   = config.get('settings', 'backlight_device')
+    device = os.path.join(root, 'backlight', name) if name else None
+    if device and not os.path.isdir(device):
+      log("No backlight device %s, using GPIO %d" % (name, pin), "WARN")
+      device = None
+    if device:
+      with open(os.path.join(device, 'max_brightness')) as f:
+        self.max  = int(f.read())
+      self.level  = self.max * config.get('settings', 'brightness', 100, int) // 100
+      self.value  = open(os.path.join(device, 'brightness'), 'w')
+      self.pwm    = True
+    else:
+      gpio = os.path.join(root, 'gpio', 'gpio%d' % pin)
+      if not os.path.exists(gpio):
+        writeFile(os.path.join(root, 'gpio', 'export'), str(pin))
+      writeFile(os.path.join(gpio, 'direction'), 'out')
+      self.value  = open(os.path.join(gpio, 'value'), 'w')
+      self.pwm    = False
+    if config.get('settings', 'backlight') == "on":
       self.on()
-    elif config['settings']['backlight'] == "off":
+    elif config.get('settings', 'backlight') == "off":
       self.off()
 
+  # on() and off() note the state in config, but leave saving it to the
+  # callers that change the preference (rather than the timeout)
   def on(self):
-    os.system("echo '1' > /sys/class/gpio/gpio508/value")
-    config['settings']['backlight'] = "on"
-  
+    self.set(True)
+    self.config.set('settings', 'backlight', "on", save=False)
+
   def off(self):
-    os.system("echo '0' > /sys/class/gpio/gpio508/value")
-    config['settings']['backlight'] = "off"
+    self.set(False)
+    self.config.set('settings', 'backlight', "off", save=False)
+
+  def set(self, on):
+    with self.lock:
+      if on == self.state: return
+      first        = self.state is None
+      now          = time.time()
+      if self.state: self.onTime += now - self.changed
+      self.state   = on
+      self.changed = now
+      self.gen    += 1
+      self.switches.inc()
+      if not self.pwm:
+        self.write(1 if on else 0)
+        return
+      if first or self.fade <= 0:
+        self.write(self.level if on else 0)
+        return
+      gen = self.gen
+    thread = threading.Thread(target=self.fadeTo,
+                              args=(self.level if on else 0, gen))
+    thread.setDaemon(True)
+    thread.start()
+
+  # Step the PWM brightness to level over self.fade seconds, giving up if
+  # the backlight is switched again in the meantime
+  def fadeTo(self, level, gen):
+    start = self.current
+    steps = 10
+    for i in range(1, steps + 1):
+      with self.lock:
+        if gen != self.gen: return
+        self.write(start + (level - start) * i // steps)
+      time.sleep(self.fade / float(steps))
+
+  # Write to the value (or brightness) file; call with lock held
+  def write(self, value):
+    self.value.seek(0)
+    self.value.write(str(value))
+    self.value.flush()
+    self.value.truncate()
+    self.current = value
+
+# DisplayPower puts the rest of the app into a low-power state while the
+# backlight is off: nothing is drawn (the framebuffer keeps its last
+# frame) and Last.fm is polled less often (by app.poller, once Last.fm
+# has been set up).  Call update() once per pass
+# of the main loop, before drawing; it returns whether to draw.  When
+# the backlight comes back on, polling resumes at full rate straight
+# away and the next frame is drawn in the same pass.  The time from the
+# backlight turning on to that frame being pushed goes into wakeLatency
+# (ms, see rendered()), and the CPU used per second asleep and awake is
+# compared in the log on every wake.
+
+class DisplayPower:
+  def __init__(self, backlight):
+    self.backlight   = backlight
+    self.asleep      = False
+    self.skipped     = 0     # Passes not drawn while asleep
+    self.wokeAt      = None  # Backlight came on, not drawn since
+    self.since       = time.time()
+    self.times       = os.times()
+    self.wall        = [0.0, 0.0] # Seconds spent [awake, asleep]
+    self.cpu         = [0.0, 0.0] # CPU seconds used [awake, asleep]
+    self.wakeLatency = metrics.histogram('wake_latency_ms', "Time from the backlight coming on to the next frame",
+                                         [10, 20, 50, 100, 200, 500, 1000, float('inf')])
+    metrics.counter('frames_skipped_total', "Frames not drawn while the display was asleep",
+                    lambda: self.skipped)
+
+  def update(self):
+    asleep = not self.backlight.state
+    if asleep != self.asleep:
+      self.account()
+      self.asleep = asleep
+      if app.poller: app.poller.setIdle(asleep)
+      if asleep:
+        log("Display asleep", "INFO")
+      else:
+        self.wokeAt = self.backlight.changed
+        log("Display awake; CPU %.1f%% asleep vs %.1f%% awake, %d frames skipped" %
+            (self.usage(1), self.usage(0), self.skipped), "INFO")
+    if asleep:
+      self.skipped += 1
+    return not asleep
+
+  # Call after each frame is drawn
+  def rendered(self):
+    if self.wokeAt is not None:
+      self.wakeLatency.add((time.time() - self.wokeAt) * 1000)
+      self.wokeAt = None
+
+  # Add the time and CPU used since the last change to the current state
+  def account(self):
+    now, times  = time.time(), os.times()
+    state       = 1 if self.asleep else 0
+    self.wall[state] += now - self.since
+    self.cpu[state]  += (times[0] + times[1]) - (self.times[0] + self.times[1])
+    self.since, self.times = now, times
+
+  # Percent of one core used while awake (0) or asleep (1)
+  def usage(self, state):
+    return 100.0 * self.cpu[state] / max(self.wall[state], 0.001)
+
+# FakeSysfs builds the parts of /sys/class that Backlight touches under
+# path, as plain files, so the driver can run without the hardware.  With
+# pwm, a backlight device named 'fake' with the given max_brightness is
+# created too (set 'backlight_device' to "fake" to use it).
+
+def FakeSysfs(path, pin=508, pwm=False, max_brightness=255):
+  gpio = os.path.join(path, 'gpio', 'gpio%d' % pin)
+  if not os.path.exists(gpio):
+    os.makedirs(gpio)
+  for name in ('export', 'gpio%d/direction' % pin, 'gpio%d/value' % pin):
+    writeFile(os.path.join(path, 'gpio', name), '')
+  if pwm:
+    device = os.path.join(path, 'backlight', 'fake')
+    if not os.path.exists(device):
+      os.makedirs(device)
+    writeFile(os.path.join(device, 'max_brightness'), str(max_brightness))
+    writeFile(os.path.join(device, 'brightness'), '0')
+  return path
+
+# Backends -----------------------------------------------------------------
+# A backend is everything that touches the hardware.  open() sets up the
+# display and touchscreen and returns the surface to draw on; update()
+# pushes rects of that surface to the display; buttons() has callback
+# called when the tact switch is pressed; backlight() makes the Backlight.
+
+# PiTFT is the real thing: SDL on the /dev/fb1 framebuffer with the TSLIB
+# touchscreen, the tact switch on GPIO 22 and the backlight in /sys/class.
+
+class PiTFT:
+  def open(self):
+    # Init framebuffer/touchscreen environment variables
+    os.putenv('SDL_VIDEODRIVER', 'fbcon')
+    os.putenv('SDL_FBDEV'      , '/dev/fb1')
+    os.putenv('SDL_MOUSEDRV'   , 'TSLIB')
+    os.putenv('SDL_MOUSEDEV'   , '/dev/input/touchscreen')
+
+    log("Initting...", "INFO")
+    pygame.init()
+    log("Setting mouse invisible...", "INFO")
+    pygame.mouse.set_visible(False)
+    log("Setting fullscreen...", "INFO")
+    modes = pygame.display.list_modes(16)
+    return pygame.display.set_mode(modes[0], FULLSCREEN, 16)
+
+  def update(self, rects):
+    pygame.display.update(rects)
+
+  def buttons(self, callback):
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(22, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO.add_event_detect(22, GPIO.FALLING, callback=callback, bouncetime=200)
+
+  def backlight(self, config):
+    return Backlight(config)
+
+# Headless runs wherever pygame does, for benchmarking and testing off the
+# Pi.  SDL's dummy video driver keeps the event queue working, drawing
+# goes to an offscreen surface (16 bit, like the PiTFT, so blits cost
+# what they would on screen), and update() only counts the frames
+# and pixels pushed.  Taps and tact switch presses are injected with
+# tap() and press(), and the Backlight drives a FakeSysfs tree.  Scratch
+# files go under path.
+
+class Headless:
+  def __init__(self, path=None, size=(320, 240)):
+    self.path     = path or tempfile.mkdtemp(prefix='screen-')
+    self.size     = size
+    self.callback = None
+    self.frames   = 0 # Frames pushed
+    self.pixels   = 0 # Pixels pushed
+
+  def open(self):
+    os.putenv('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    pygame.display.set_mode(self.size, 0, 16)
+    return pygame.Surface(self.size).convert()
+
+  def update(self, rects):
+    self.frames += 1
+    self.pixels += sum(pygame.Rect(r).w * pygame.Rect(r).h for r in rects)
+
+  def buttons(self, callback):
+    self.callback = callback
+
+  def backlight(self, config):
+    return Backlight(config, FakeSysfs(os.path.join(self.path, 'sys')))
+
+  def tap(self, pos):
+    pygame.event.post(pygame.event.Event(MOUSEBUTTONDOWN, pos=pos, button=1))
+
+  def press(self, channel=22):
+    if self.callback: self.callback(channel)
+
+# Touchscreen reads taps straight from the touchscreen's evdev device on a
+# thread of its own, for backends where SDL doesn't.  A touch is posted as
+# a MOUSEBUTTONDOWN at the point it started, like SDL would.  Raw
+# coordinates are mapped to the screen with tslib's calibration
+# (/etc/pointercal) when there is one, otherwise by scaling the device's
+# axis ranges.
+
+class Touchscreen:
+  EVENT     = struct.Struct('llHHi') # struct input_event
+  ABSINFO   = struct.Struct('6i')    # struct input_absinfo
+  EVIOCGABS = 0x80184540             # _IOR('E', 0x40 + axis, input_absinfo)
+
+  def __init__(self, device="/dev/input/touchscreen", size=(320, 240),
+               calibration="/etc/pointercal"):
+    self.device      = device
+    self.size        = size
+    self.calibration = None
+    self.ranges      = [(0, size[0]), (0, size[1])] # Raw (min, max) of each axis
+    try:
+      with open(calibration) as infile:
+        self.calibration = [int(n) for n in infile.read().split()[:7]]
+    except (IOError, OSError, ValueError):
+      pass
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self):
+    x = y = 0
+    touched = False
+    try:
+      with open(self.device, 'rb') as device:
+        try:
+          self.ranges = [self.ABSINFO.unpack(fcntl.ioctl(device, self.EVIOCGABS + axis,
+                         '\0' * self.ABSINFO.size))[1:3] for axis in (0, 1)]
+        except IOError:
+          pass # Not an evdev device; take the coordinates as they are
+        while True:
+          data = device.read(self.EVENT.size)
+          if len(data) < self.EVENT.size: break
+          sec, usec, type, code, value = self.EVENT.unpack(data)
+          if type == 3:                     # EV_ABS
+            if code == 0: x = value         # ABS_X
+            elif code == 1: y = value       # ABS_Y
+          elif type == 1 and code == 0x14a: # EV_KEY, BTN_TOUCH
+            touched = value == 1
+          elif type == 0 and touched:       # EV_SYN, once the touch has a position
+            touched = False
+            pygame.event.post(pygame.event.Event(MOUSEBUTTONDOWN,
+                              pos=self.position(x, y), button=1))
+    except (IOError, OSError) as e:
+      log("Can't read the touchscreen: " + str(e), "ERROR")
+
+  def position(self, x, y):
+    if self.calibration:
+      a = self.calibration
+      px = (a[2] + a[0] * x + a[1] * y) // a[6]
+      py = (a[5] + a[3] * x + a[4] * y) // a[6]
+    else:
+      (xmin, xmax), (ymin, ymax) = self.ranges
+      px = (x - xmin) * self.size[0] // max(xmax - xmin, 1)
+      py = (y - ymin) * self.size[1] // max(ymax - ymin, 1)
+    return (min(max(px, 0), self.size[0] - 1), min(max(py, 0), self.size[1] - 1))
+
+# Framebuffer skips SDL's fbcon driver, which is deprecated in newer SDL
+# and copies every frame through itself.  Drawing goes to an offscreen
+# RGB565 surface, and update() copies just the dirty rects, row by row,
+# straight into an mmap of the framebuffer device (a rect as wide as the
+# screen goes in one copy).  SDL is only opened with its dummy driver, for
+# the event queue, and taps come from a Touchscreen.  The geometry comes
+# from /sys/class/graphics when the device is a character device with an
+# entry there, otherwise it's size, so a regular file of the right size
+# can stand in for the device.  Pixels are copied from the surface's own
+# memory where pygame exposes its address (1.9.2 on), otherwise from a
+# copy of them.  If the device can't be mapped, or isn't 16 bit, this
+# falls back to the PiTFT backend, which also provides the tact switch
+# and backlight.
+
+class Framebuffer:
+  def __init__(self, device="/dev/fb1", size=(320, 240),
+               touchscreen="/dev/input/touchscreen"):
+    self.device      = device
+    self.size        = size
+    self.stride      = size[0] * 2 # Bytes per row of the framebuffer
+    self.touchscreen = touchscreen
+    self.sdl         = PiTFT()
+    self.map         = None
+
+  def open(self):
+    try:
+      self.geometry()
+      fd = os.open(self.device, os.O_RDWR)
+      try:
+        self.map = mmap.mmap(fd, self.stride * self.size[1])
+      finally:
+        os.close(fd)
+    except (EnvironmentError, ValueError) as e:
+      log("Can't map %s (%s), falling back to SDL" % (self.device, e), "WARN")
+      return self.sdl.open()
+
+    os.putenv('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    pygame.display.set_mode(self.size, 0, 16)
+    self.surface = pygame.Surface(self.size, 0, 16, (0xF800, 0x07E0, 0x001F, 0))
+    self.base    = ctypes.addressof(ctypes.c_char.from_buffer(self.map))
+    self.direct  = hasattr(self.surface, '_pixels_address')
+    if self.touchscreen:
+      Touchscreen(self.touchscreen, self.size).start()
+    log("Drawing straight to %s (%dx%d)" % ((self.device,) + self.size), "INFO")
+    return self.surface
+
+  def geometry(self):
+    if not stat.S_ISCHR(os.stat(self.device).st_mode): return # A stand-in file
+    sysfs = os.path.join('/sys/class/graphics', os.path.basename(self.device))
+    if not os.path.isdir(sysfs): return
+    with open(os.path.join(sysfs, 'bits_per_pixel')) as infile:
+      bits = int(infile.read())
+    if bits != 16:
+      raise ValueError("%d bits per pixel" % bits)
+    with open(os.path.join(sysfs, 'virtual_size')) as infile:
+      self.size = tuple(int(n) for n in infile.read().split(','))
+    with open(os.path.join(sysfs, 'stride')) as infile:
+      self.stride = int(infile.read())
+
+  def update(self, rects):
+    if self.map is None:
+      return self.sdl.update(rects)
+    screen = self.surface.get_rect()
+    pitch  = self.surface.get_pitch()
+    self.surface.lock()
+    try:
+      if self.direct:
+        address = self.surface._pixels_address
+        pixels  = lambda offset, n: address + offset
+      else:
+        raw     = self.surface.get_buffer().raw
+        pixels  = lambda offset, n: raw[offset:offset + n]
+      for rect in rects:
+        rect = pygame.Rect(rect).clip(screen)
+        if rect.w == screen.w and pitch == self.stride:
+          ctypes.memmove(self.base + rect.y * self.stride,
+                         pixels(rect.y * pitch, rect.h * pitch), rect.h * pitch)
+          continue
+        for y in range(rect.y, rect.bottom):
+          ctypes.memmove(self.base + y * self.stride + rect.x * 2,
+                         pixels(y * pitch + rect.x * 2, rect.w * 2), rect.w * 2)
+    finally:
+      self.surface.unlock()
+
+  def buttons(self, callback):
+    self.sdl.buttons(callback)
+
+  def backlight(self, config):
+    return self.sdl.backlight(config)
+
+# Background services ------------------------------------------------------
+# These run on their own threads and hand results to the main loop, so the
+# main loop never waits on the network.
+
+# ConfigStore holds the configuration and preferences from config.json.
+# get() and set() are safe to call from any thread; get() returns default
+# for a missing key and can convert the value (e.g. with int).  set()
+# doesn't write the file itself: saves are coalesced into one write,
+# made on a timer thread window seconds after the last change.  The file
+# is only written if its contents actually changed, and then atomically
+# (to a temporary file which is fsynced and renamed over config.json),
+# so a power cut mid-write can't leave a truncated config.
+
+class ConfigStore:
+  def __init__(self, path, data, window=2.0):
+    self.path   = path
+    self.data   = data
+    self.window = window
+    self.lock   = threading.Lock()
+    self.write  = threading.Lock() # Held while writing the file
+    self.timer  = None
+    self.saved  = self.dump()      # Contents as last written
+    self.writes = metrics.histogram('config_write_ms', "Time taken to save config.json",
+                                    [5, 10, 25, 50, 100, 250, 1000, float('inf')])
+
+  def get(self, section, key, default=None, type=None):
+    with self.lock:
+      value = self.data.get(section, {}).get(key, default)
+    if type is not None and value is not None:
+      value = type(value)
+    return value
+
+  # Change a value; with save=False it's only kept in memory (until some
+  # other change is saved)
+  def set(self, section, key, value, save=True):
+    with self.lock:
+      self.data.setdefault(section, {})[key] = value
+      if not save: return
+      if self.timer: self.timer.cancel()
+      self.timer = threading.Timer(self.window, self.flush)
+      self.timer.setDaemon(True)
+      self.timer.start()
+
+  def dump(self):
+    with self.lock:
+      return json.dumps(self.data, indent=2, sort_keys=True)
+
+  # Write the file now if anything changed (or regardless, with force).
+  # Readers aren't held up while the file is written.
+  def flush(self, force=False):
+    with self.lock:
+      timer, self.timer = self.timer, None
+    if timer and timer is not threading.current_thread():
+      timer.cancel() # Written now, no need to wait
+      timer.join()   # Gone before the caller exits, say
+    with self.write:
+      text = self.dump()
+      if text == self.saved and not force:
+        return
+      with timed(self.writes):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as outfile:
+          outfile.write(text)
+          outfile.flush()
+          os.fsync(outfile.fileno())
+        os.rename(tmp, self.path)
+      self.saved = text
+
+# MirrorIcons decodes the base64 icons of mirrored notifications in
+# memory into size, display-format surfaces.  It runs on the websocket
+# thread as notifications arrive, and keeps the icons of the last keep
+# apps by package name, so repeat notifications from the same app don't
+# decode it again.
+
+class MirrorIcons:
+  def __init__(self, size=(72, 72), keep=16):
+    self.size  = size
+    self.keep  = keep
+    self.icons = collections.OrderedDict() # Package name -> surface
+    self.lock  = threading.Lock()
+
+  def get(self, package, data):
+    with self.lock:
+      bitmap = self.icons.pop(package, None)
+      if bitmap is not None:
+        self.icons[package] = bitmap # Re-insert as most recently used
+        return bitmap
+    try:
+      bitmap = pygame.image.load(io.BytesIO(base64.b64decode(data)), 'icon.png')
+      bitmap = convertBitmap(pygame.transform.scale(bitmap, self.size))
+    except Exception as e:
+      log("Failed to decode notification icon: " + str(e), "ERROR")
+      return None
+    if package:
+      with self.lock:
+        self.icons[package] = bitmap
+        while len(self.icons) > self.keep:
+          self.icons.popitem(last=False)
+    return bitmap
+
+# PushbulletAPI makes every Pushbullet REST call over one keep-alive
+# requests.Session, so the TLS handshake is only done once.  It tracks
+# the highest 'modified' time of the pushes it has fetched, so each
+# newPushes() only downloads pushes it hasn't seen (starting from the
+# last 100 seconds).  The device list is fetched once and kept in
+# devices until getDevices() is asked to refresh it.
+
+class PushbulletAPI:
+  url = "https://api.pushbullet.com/v2/"
+
+  def __init__(self, key, url=None, timeout=10):
+    if url: self.url  = url
+    self.session      = requests.Session()
+    self.session.auth = (key, '')
+    self.timeout      = timeout
+    self.modified     = time.time() - 100 # Newest push seen
+    self.devices      = None
+
+  def get(self, path, **params):
+    with timed(metrics.histogram('http_request_ms', "Time taken by HTTP requests",
+                                 httpBuckets, service="pushbullet")):
+      r = self.session.get(self.url + path, params=params, timeout=self.timeout)
+    r.raise_for_status()
+    return r.json()
+
+  # New or changed pushes since the last call, newest first
+  def newPushes(self):
+    since  = self.modified
+    pushes = self.get("pushes", modified_after="%f" % since)['pushes']
+    pushes = [p for p in pushes if p.get('modified', 0) > since]
+    for p in pushes:
+      self.modified = max(self.modified, p['modified'])
+    return pushes
+
+  def getDevices(self, refresh=False):
+    if self.devices is None or refresh:
+      self.devices = self.get("devices")['devices']
+    return self.devices
+
+# PushbulletStream keeps the Pushbullet websocket at url connected, on
+# its own thread, passing each message to onMessage(ws, message, arrived)
+# (arrived being when it came in) and calling onOpen(ws) on every
+# (re)connect.  The stream sends a "nop" heartbeat every 30 seconds, so
+# if nothing arrives for timeout seconds the connection is taken to be
+# dead and closed.  A closed connection is reopened after a delay that
+# starts at minDelay and doubles with each attempt (up to maxDelay), and
+# goes back to minDelay once a connection has stayed up for timeout
+# seconds.  connected (when the current connection opened, or None),
+# reconnects and latency (ms from a message arriving to it being shown,
+# see displayed()) are kept for reporting.
+
+class PushbulletStream:
+  def __init__(self, url, onMessage, onOpen, timeout=90, minDelay=1, maxDelay=300):
+    self.url         = url
+    self.onMessage   = onMessage
+    self.onOpen      = onOpen
+    self.timeout     = timeout
+    self.minDelay    = minDelay
+    self.maxDelay    = maxDelay
+    self.ws          = None
+    self.connected   = None
+    self.lastMessage = 0
+    self.reconnects  = 0
+    self.latency     = metrics.histogram('pushbullet_display_latency_ms',
+                                         "Time from a push arriving to it being shown",
+                                         [100, 250, 500, 1000, 2500, 5000, 10000, float('inf')])
+    self.handling    = metrics.histogram('pushbullet_message_ms', "Time taken to handle a stream message",
+                                         [1, 5, 10, 50, 100, 500, 1000, 5000, float('inf')])
+    metrics.counter('pushbullet_reconnects_total', "Pushbullet stream reconnections",
+                    lambda: self.reconnects)
+    metrics.gauge('pushbullet_connected', "Whether the Pushbullet stream is connected",
+                  lambda: 1 if self.connected else 0)
+
+  def start(self):
+    for target in (self.run, self.watchdog):
+      thread = threading.Thread(target=target)
+      thread.setDaemon(True)
+      thread.start()
+
+  def run(self):
+    delay = self.minDelay
+    while True:
+      self.ws = websocket.WebSocketApp(self.url,
+        on_open    = lambda ws: self.opened(ws),
+        on_message = lambda ws, message: self.received(ws, message))
+      self.ws.run_forever()
+      uptime = time.time() - self.connected if self.connected else 0
+      if uptime >= self.timeout:
+        delay = self.minDelay
+      self.connected = None
+      log("Pushbullet stream closed after %ds, reconnecting in %gs (%s)" %
+          (uptime, delay, self.stats()), "WARN")
+      time.sleep(delay * random.uniform(0.8, 1.2))
+      delay = min(delay * 2, self.maxDelay)
+      self.reconnects += 1
+
+  def opened(self, ws):
+    self.connected   = time.time()
+    self.lastMessage = self.connected
+    self.onOpen(ws)
+
+  def received(self, ws, message):
+    self.lastMessage = time.time()
+    with timed(self.handling):
+      self.onMessage(ws, message, self.lastMessage)
+
+  # Close the connection if the heartbeats stop, so run() reconnects
+  def watchdog(self):
+    while True:
+      time.sleep(min(10, self.timeout / 3.0))
+      if self.connected and time.time() - self.lastMessage > self.timeout:
+        log("No Pushbullet heartbeat for %ds, reconnecting" % self.timeout, "WARN")
+        self.ws.close()
+
+  # Record how long a notification from the stream took to be shown
+  def displayed(self, notification):
+    self.latency.add((time.time() - notification.time) * 1000)
+
+  def stats(self):
+    uptime = time.time() - self.connected if self.connected else 0
+    return "up %ds, %d reconnects, display latency (ms): %s" % (
+      uptime, self.reconnects, self.latency.summary())
+
+# Notification is a push ("push") or mirrored notification ("mirror")
+# waiting to be shown; count is how many were coalesced into it.
+
+Notification = collections.namedtuple('Notification',
+                                      'kind data source time count')
+
+# NotificationQueue holds notifications until there's room to show them.
+# put() is safe to call from any thread.  A notification arriving within
+# window seconds of the last one queued is coalesced into it, whatever
+# its source, the latest replacing the one still queued (the panel shows
+# how many more there were), so a burst is shown once rather than one
+# after another.  Only beyond maxlen is the oldest dropped.  The queue's
+# length and the dropped and coalesced counts are kept as metrics.
+
+class NotificationQueue:
+  def __init__(self, maxlen=10, window=2):
+    self.items     = collections.deque()
+    self.maxlen    = maxlen
+    self.window    = window
+    self.lock      = threading.Lock()
+    metrics.gauge('notification_queue_length', "Notifications waiting to be shown",
+                  fn=self.__len__)
+    self.dropped   = metrics.counter('notifications_dropped_total',
+                                     "Notifications dropped from a full queue")
+    self.coalesced = metrics.counter('notifications_coalesced_total',
+                                     "Notifications coalesced into one still queued")
+
+  def __len__(self):
+    return len(self.items)
+
+  def put(self, kind, data, source=None, now=None):
+    if now is None: now = time.time()
+    with self.lock:
+      if self.items and now - self.items[-1].time < self.window:
+        self.items[-1] = Notification(kind, data, source, now, self.items[-1].count + 1)
+        self.coalesced.inc()
+        return
+      if len(self.items) >= self.maxlen:
+        self.items.popleft()
+        self.dropped.inc()
+        log("Notification queue full, dropped %d so far" % self.dropped.value(), "WARN")
+      self.items.append(Notification(kind, data, source, now, 1))
+
+  def get(self):
+    with self.lock:
+      if self.items:
+        return self.items.popleft()
+    return None
+
+# NotificationLog is the history of pushes and notifications, kept in a
+# fixed-size ring file at path of slots records, slot bytes each, that's
+# memory-mapped; once full, each record written replaces the oldest.  A
+# record is its sequence number, time, and the kind, source and the
+# FIELDS of the notification worth showing as JSON (long ones are cut
+# short to fit).  Opening the file indexes what's in it by time, by
+# source device and (for pushes) by iden, so the last notifications are
+# there straight after a restart without asking Pushbullet, and append()
+# can turn away a push it has already logged.  A slot that won't decode
+# (torn by a power cut mid-write, say) is taken to be empty.  Records
+# are unpacked straight from the map.  Safe to use from any thread.
+
+class NotificationLog:
+  HEADER = struct.Struct('<4sIIQ') # Magic, slot bytes, slots, records written
+  RECORD = struct.Struct('<QdH')   # Sequence number, time, JSON length
+  MAGIC  = 'NLG1'
+  FIELDS = ('type', 'title', 'body', 'url', 'file_name', 'iden',
+            'sender_name', 'sender_email_normalized', 'source_device_iden',
+            'target_device_iden', 'application_name', 'package_name')
+
+  def __init__(self, path="cache/notifications.ring", slots=256, slot=512):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    self.slots   = slots
+    self.slot    = slot
+    self.lock    = threading.Lock()
+    self.times   = [] # Times of the records held, oldest first
+    self.seqs    = [] # Their sequence numbers, parallel to times
+    self.sources = {} # Source -> deque of sequence numbers
+    self.idens   = {} # Push iden -> sequence number
+    size = self.HEADER.size + slots * slot
+    new  = not os.path.exists(path) or os.path.getsize(path) != size
+    self.file = open(path, 'w+b' if new else 'r+b')
+    if new:
+      self.file.truncate(size)
+    self.map = mmap.mmap(self.file.fileno(), size)
+    magic, slotBytes, slotCount, self.written = self.HEADER.unpack_from(self.map, 0)
+    if magic != self.MAGIC or slotBytes != slot or slotCount != slots:
+      self.written = 0
+      self.HEADER.pack_into(self.map, 0, self.MAGIC, slot, slots, 0)
+    for seq in range(max(0, self.written - slots), self.written):
+      record = self.read(seq)
+      if record: self.index(seq, record)
+
+  def index(self, seq, record):
+    self.times.append(record.time)
+    self.seqs.append(seq)
+    self.sources.setdefault(record.source, collections.deque()).append(seq)
+    if record.kind == "push" and record.data.get('iden'):
+      self.idens[record.data['iden']] = seq
+
+  # Drop the oldest record from the indexes
+  def unindex(self, record):
+    del self.times[0]
+    seq = self.seqs.pop(0)
+    seqs = self.sources.get(record.source)
+    if seqs:
+      seqs.popleft()
+      if not seqs: del self.sources[record.source]
+    if record.kind == "push" and self.idens.get(record.data.get('iden')) == seq:
+      del self.idens[record.data['iden']]
+
+  # Log a notification; returns False (logging nothing) for a push that's
+  # already in the log
+  def append(self, kind, data, source=None, now=None):
+    if now is None: now = time.time()
+    data = dict((k, data[k]) for k in self.FIELDS if data.get(k) is not None)
+    text = self.pack(kind, data, source)
+    with self.lock:
+      if kind == "push" and data.get('iden') in self.idens:
+        return False
+      seq = self.written
+      if seq >= self.slots:
+        old = self.read(seq - self.slots)
+        if old: self.unindex(old)
+      offset = self.HEADER.size + (seq % self.slots) * self.slot
+      self.RECORD.pack_into(self.map, offset, seq, now, len(text))
+      self.map[offset + self.RECORD.size:offset + self.RECORD.size + len(text)] = text
+      self.written = seq + 1
+      self.HEADER.pack_into(self.map, 0, self.MAGIC, self.slot, self.slots, self.written)
+      self.map.flush()
+      self.index(seq, Notification(kind, data, source, now, 1))
+    return True
+
+  # JSON for a record, halving the longest string (a field or the source)
+  # until it fits.  If it still doesn't once they're all empty, the JSON
+  # is cut short, and the record will read back as empty.
+  def pack(self, kind, data, source):
+    room   = self.slot - self.RECORD.size
+    record = {'kind': kind, 'source': source, 'data': dict(data)}
+    while True:
+      text = json.dumps(record, separators=(',', ':'))
+      if len(text) <= room: return text
+      strings = [(d, k) for d in (record, record['data']) for k, v in d.iteritems()
+                 if k != 'kind' and isinstance(v, basestring) and v]
+      if not strings: return text[:room]
+      d, k = max(strings, key=lambda string: len(string[0][string[1]]))
+      d[k] = d[k][:len(d[k]) // 2]
+
+  # The record with sequence number seq, or None if it's been overwritten
+  def read(self, seq):
+    offset = self.HEADER.size + (seq % self.slots) * self.slot
+    rseq, when, length = self.RECORD.unpack_from(self.map, offset)
+    if rseq != seq or not 0 < length <= self.slot - self.RECORD.size:
+      return None
+    start  = offset + self.RECORD.size
+    try:
+      record = json.loads(self.map[start:start + length])
+      return Notification(record['kind'], dict(record['data']), record['source'], when, 1)
+    except (ValueError, KeyError, TypeError):
+      return None
+
+  def count(self):
+    return len(self.seqs)
+
+  # count records, newest first, skipping the first offset
+  def page(self, offset, count):
+    with self.lock:
+      seqs = self.seqs[max(0, len(self.seqs) - offset - count):len(self.seqs) - offset]
+      return [self.read(seq) for seq in reversed(seqs)]
+
+  # Records logged at or after when, oldest first
+  def since(self, when):
+    with self.lock:
+      return [self.read(seq) for seq in self.seqs[bisect.bisect_left(self.times, when):]]
+
+  # Records from a source device (or app, for mirrored notifications),
+  # oldest first
+  def fromSource(self, source):
+    with self.lock:
+      return [self.read(seq) for seq in self.sources.get(source, ())]
+
+# NowPlaying is an immutable snapshot of the track being scrobbled.
+
+NowPlaying = collections.namedtuple('NowPlaying', 'artist album title cover')
+
+# NowPlayingPoller asks Last.fm what's playing every interval seconds on
+# its own thread.  On errors it backs off, doubling the delay up to
+# maxInterval, and every delay is jittered so retries don't line up.
+# Album and cover are looked up with a single track.getInfo request,
+# and only when the track changes.  snapshot is None when nothing is
+# playing, otherwise a NowPlaying; whenever it changes it's posted to the
+# main loop in a NowPlayingEvent, and history (a ScrobbleHistory, if
+# given) is nudged to sync, the last track having likely scrobbled.
+# While the display is asleep, setIdle(True) slows polling down to
+# idleInterval seconds; setIdle(False) polls straight away and goes back
+# to interval.
+
+class NowPlayingPoller:
+  def __init__(self, user, interval=5, maxInterval=120, idleInterval=None,
+               history=None):
+    self.user         = user
+    self.history      = history
+    self.interval     = interval
+    self.maxInterval  = maxInterval
+    self.idleInterval = idleInterval or interval * 4
+    self.idle         = False
+    self.nudge        = threading.Event() # Set to poll straight away
+    self.failures     = 0    # Consecutive failed polls
+    self.snapshot     = None
+    self.request      = metrics.histogram('http_request_ms', "Time taken by HTTP requests",
+                                          httpBuckets, service="lastfm")
+    self.errors       = metrics.counter('lastfm_poll_failures_total', "Failed now playing polls")
+    self.stalls       = metrics.counter('lastfm_poll_stalls_total',
+                                        "Now playing polls that took longer than the poll interval")
+
+  def setIdle(self, idle):
+    self.idle = idle
+    if not idle:
+      self.nudge.set()
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self):
+    while True:
+      interval = self.idleInterval if self.idle else self.interval
+      start    = time.time()
+      try:
+        self.poll()
+        self.failures = 0
+        delay = interval
+      except Exception as e:
+        log("Failed to get now playing: " + str(e), "ERROR")
+        self.errors.inc()
+        self.failures += 1
+        delay = max(interval,
+                    min(self.maxInterval, self.interval * 2 ** self.failures))
+      if time.time() - start > self.interval:
+        self.stalls.inc()
+      self.nudge.wait(delay * random.uniform(0.8, 1.2))
+      self.nudge.clear()
+
+  def poll(self):
+    with timed(self.request):
+      track = self.user.get_now_playing()
+    if track is None:
+      if self.snapshot is not None:
+        self.snapshot = None
+        post(NowPlayingEvent(time.time(), None))
+        self.changed()
+      return
+    artist = track.artist.get_name()
+    title  = track.get_title()
+    if (self.snapshot is None or self.snapshot.artist != artist or
+        self.snapshot.title != title):
+      with timed(self.request):
+        album, cover = trackInfo(track)
+      self.snapshot = NowPlaying(artist, album, title, cover)
+      post(NowPlayingEvent(time.time(), self.snapshot))
+      self.changed()
+
+  def changed(self):
+    if self.history:
+      self.history.nudge.set()
+
+# MetricsExporter writes the Metrics to a Prometheus text file at path
+# every interval seconds, for node_exporter's textfile collector (or
+# anything else) to pick up.  The file is replaced in one go, so it's
+# never read half written.  The default path is on tmpfs, so a write
+# every interval doesn't wear the SD card.
+
+class MetricsExporter:
+  def __init__(self, metrics, path="/run/screen/metrics.prom", interval=15):
+    self.metrics  = metrics
+    self.path     = path
+    self.interval = interval
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self):
+    while True:
+      try:
+        self.write()
+      except (IOError, OSError) as e:
+        log("Failed to write metrics: " + str(e), "ERROR")
+      time.sleep(self.interval)
+
+  def write(self):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as outfile:
+      outfile.write(self.metrics.text())
+    os.rename(tmp, self.path)
+
+# SamplingProfiler, once start()ed, samples the stack of every thread each
+# interval seconds for duration seconds, on a thread of its own.  The
+# samples are written to path (a strftime pattern) as collapsed stacks,
+# "thread;outer;...;inner count" a line, ready for flamegraph.pl, and
+# the functions most often on top are logged.  It's started by SIGUSR1
+# (kill -USR1 <pid>); Python only runs signal handlers on the main
+# thread, so it starts when the main loop next wakes.
+
+class SamplingProfiler:
+  def __init__(self, path="cache/profile-%Y%m%d-%H%M%S.txt",
+               interval=0.005, duration=10):
+    self.path     = path
+    self.interval = interval
+    self.duration = duration
+    self.running  = False
+
+  def start(self, *args): # Also called as a signal handler
+    if self.running: return
+    self.running = True
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self):
+    log("Profiling for %gs..." % self.duration, "INFO")
+    me      = threading.current_thread().ident
+    stacks  = {} # Collapsed stack -> samples
+    top     = {} # Innermost function -> samples
+    samples = 0
+    end     = time.time() + self.duration
+    while time.time() < end:
+      names = dict((t.ident, t.name) for t in threading.enumerate())
+      for ident, frame in sys._current_frames().items():
+        if ident == me: continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append("%s (%s:%d)" % (code.co_name,
+                       os.path.basename(code.co_filename), code.co_firstlineno))
+          frame = frame.f_back
+        key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+        stacks[key]   = stacks.get(key, 0) + 1
+        top[stack[0]] = top.get(stack[0], 0) + 1
+      samples += 1
+      time.sleep(self.interval)
+    try:
+      path = time.strftime(self.path)
+      with open(path, 'w') as outfile:
+        for key, count in sorted(stacks.items()):
+          outfile.write("%s %d\n" % (key, count))
+      busiest = sorted(top.items(), key=lambda item: -item[1])[:5]
+      log("Profile of %d samples written to %s; most often on top: %s" %
+          (samples, path, ", ".join("%s %d" % item for item in busiest)), "INFO")
+    except (IOError, OSError) as e:
+      log("Failed to write profile: " + str(e), "ERROR")
+    finally:
+      self.running = False
+
+# Scrobble is one play from the scrobble history.
+
+Scrobble = collections.namedtuple('Scrobble', 'time artist album title')
+
+# ScrobbleHistory keeps the user's scrobbles in a SQLite database at path,
+# so the history screens page through them with local, indexed queries
+# and never wait on the network.  Its thread syncs from Last.fm every
+# interval seconds, and settle seconds after nudge is set (giving the
+# track that just finished time to scrobble), asking only for scrobbles
+# after the newest one stored; the very first sync fetches the last
+# backfill.  A sync that adds anything bumps version and posts it to the
+# main loop in a HistoryEvent.  The connection is shared by the threads,
+# under lock.
+
+class ScrobbleHistory:
+  def __init__(self, path, user, interval=600, settle=20, backfill=200):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    self.user     = user
+    self.interval = interval
+    self.settle   = settle
+    self.backfill = backfill
+    self.version  = 0
+    self.nudge    = threading.Event() # Set to sync (after settle seconds)
+    self.lock     = threading.Lock()
+    self.db       = sqlite3.connect(path, check_same_thread=False)
+    with self.lock:
+      self.db.execute("CREATE TABLE IF NOT EXISTS scrobbles ("
+                      "time INTEGER NOT NULL, artist TEXT NOT NULL, "
+                      "album TEXT, title TEXT NOT NULL, "
+                      "PRIMARY KEY (time, artist, title))")
+      self.db.execute("CREATE INDEX IF NOT EXISTS scrobbles_track "
+                      "ON scrobbles (artist, title)")
+      self.db.commit()
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def run(self):
+    while True:
+      try:
+        self.sync()
+      except Exception as e:
+        log("Failed to sync scrobble history: " + str(e), "ERROR")
+      self.nudge.wait(self.interval)
+      if self.nudge.is_set():
+        self.nudge.clear()
+        time.sleep(self.settle)
+
+  # Fetch and store the scrobbles newer than the newest one stored;
+  # returns how many were added
+  def sync(self):
+    newest = self.newest()
+    if newest is None:
+      played = self.user.get_recent_tracks(limit=self.backfill, cacheable=False)
+    else:
+      played = self.user.get_recent_tracks(limit=None, cacheable=False,
+                                           time_from=newest + 1)
+    rows = [(int(p.timestamp), p.track.artist.get_name(), p.album or "",
+             p.track.get_title()) for p in played]
+    if not rows: return 0
+    with self.lock:
+      changes = self.db.total_changes
+      self.db.executemany("INSERT OR IGNORE INTO scrobbles VALUES (?, ?, ?, ?)", rows)
+      self.db.commit()
+      added = self.db.total_changes - changes
+    if added:
+      log("Synced %d new scrobbles" % added, "INFO")
+      self.version += 1
+      post(HistoryEvent(time.time(), self.version))
+    return added
+
+  def query(self, sql, args=()):
+    with self.lock:
+      return self.db.execute(sql, args).fetchall()
+
+  # Time of the newest scrobble stored, or None if there are none
+  def newest(self):
+    return self.query("SELECT MAX(time) FROM scrobbles")[0][0]
+
+  def count(self):
+    return self.query("SELECT COUNT(*) FROM scrobbles")[0][0]
+
+  # count scrobbles, newest first, skipping the first offset
+  def page(self, offset, count):
+    return [Scrobble(*row) for row in self.query(
+      "SELECT time, artist, album, title FROM scrobbles "
+      "ORDER BY time DESC LIMIT ? OFFSET ?", (count, offset))]
+
+  # How many times a track has been scrobbled
+  def plays(self, artist, title):
+    return self.query("SELECT COUNT(*) FROM scrobbles "
+                      "WHERE artist = ? AND title = ?", (artist, title))[0][0]
+
+# Application state --------------------------------------------------------
+# All of the app's state lives in one AppState, owned by the main thread.
+# Background threads never change it; they post() events, which the main
+# loop applies in order, followed by a TickEvent on every pass.  Input
+# is applied as events too.  Every event carries the time it happened,
+# so a recorded list of events replays to the same result (see Replay()).
+
+NowPlayingEvent = collections.namedtuple('NowPlayingEvent', 'time snapshot')
+NoticeEvent     = collections.namedtuple('NoticeEvent', 'time kind data source')
+TapEvent        = collections.namedtuple('TapEvent', 'time pos')
+ButtonEvent     = collections.namedtuple('ButtonEvent', 'time button')
+TickEvent       = collections.namedtuple('TickEvent', 'time')
+HistoryEvent    = collections.namedtuple('HistoryEvent', 'time version')
+PollerEvent     = collections.namedtuple('PollerEvent', 'time poller')
+
+# AppState also holds what the event handlers and UI callbacks act on:
+# config (the ConfigStore) and grids (each screen mode's HitGrid), so a
+# replay can be given its own rather than the app's.
+
+class AppState:
+  def __init__(self, now, backlight, notices, config, grids, duration=7):
+    self.backlight     = backlight
+    self.notices       = notices   # Notifications waiting to be shown
+    self.config        = config
+    self.grids         = grids
+    self.poller        = None      # NowPlayingPoller, once Last.fm is set up
+    self.duration      = duration  # Seconds each notification is shown
+    self.now           = now       # Time of the event being applied
+    self.mode          = 0         # Current screen mode; default = clock
+    self.modePrior     = -1        # Prior screen mode (for detecting changes)
+    self.awakeSince    = now       # Last activity, for the backlight timeout
+    self.numberstring  = "0"       # Backlight timer numerical input
+    self.playing       = None      # Latest NowPlaying from Last.fm, if any
+    self.track         = NowPlaying(" ", " ", " ", False) # Shown on Now Playing
+    self.notice        = None      # Notification being shown
+    self.noticeExpires = 0
+    self.shown         = None      # Notification first shown by the last tick
+    self.sleepAt       = None      # When the backlight will time out
+    self.historyPage    = 0        # Page of the scrobble history shown
+    self.historyVersion = 0        # Bumped when the history syncs
+    self.historyTrack   = Scrobble(0, " ", " ", " ") # Scrobble in Track Info
+    self.historyPlays   = 0        # Times historyTrack has been scrobbled
+    self.noticePage     = 0        # Page of the notification history shown
+    self.noticesLogged  = 0        # Bumped as notifications arrive
+    self.handlers      = {
+      NowPlayingEvent: self.onNowPlaying,
+      NoticeEvent:     self.onNotice,
+      TapEvent:        self.onTap,
+      ButtonEvent:     self.onButton,
+      TickEvent:       self.onTick,
+      HistoryEvent:    self.onHistory,
+      PollerEvent:     self.onPoller }
+
+  def apply(self, event):
+    self.now = event.time
+    self.handlers[type(event)](event)
+
+  def onNowPlaying(self, event):
+    self.playing = event.snapshot
+
+  def onNotice(self, event):
+    self.notices.put(event.kind, event.data, event.source, event.time)
+    self.noticesLogged += 1
+
+  def onHistory(self, event):
+    self.historyVersion = event.version
+
+  # Last.fm is set up; poll it slowly if the display's already asleep
+  def onPoller(self, event):
+    self.poller = event.poller
+    self.poller.setIdle(not self.backlight.state)
+
+  # A tap on the touchscreen; the first Button under it takes it
+  def onTap(self, event):
+    b = self.grids[self.mode].hit(event.pos)
+    if b: b.press()
+
+  # The tact switch toggles the backlight
+  def onButton(self, event):
+    if event.button == 2:
+      toggleBacklight()
+
+  def onTick(self, event):
+    self.checkNowPlaying()
+    self.checkNotices()
+    if self.mode == 1: # Settings
+      self.awakeSince = self.now
+    self.checkBacklight()
+
+  # Switch between the Clock and Now Playing screens depending on whether
+  # anything is scrobbling (leaving the history screens be)
+  def checkNowPlaying(self):
+    self.modePrior = self.mode
+    if self.playing and self.mode not in (3, 4, 6):
+      if self.track.title != self.playing.title:
+        self.awakeSince = self.now
+        self.backlight.on()
+        self.track = self.playing
+      self.mode = 2
+    elif self.mode == 0 or self.mode == 2:
+      if self.modePrior != 0:
+        self.backlight.on()
+        self.awakeSince = self.now
+      self.mode = 0
+
+  # Show the next push or notification once the current one has expired
+  def checkNotices(self):
+    self.shown = None
+    if not self.notice or self.now >= self.noticeExpires:
+      self.notice = self.notices.get()
+      if self.notice:
+        self.noticeExpires = self.now + self.duration
+        self.shown         = self.notice
+    if self.notice:
+      self.backlight.on()
+      self.awakeSince = self.now
+
+  # Sleep (turn off the backlight) after x seconds defined in the config
+  def checkBacklight(self):
+    self.sleepAt = None
+    if self.mode != 0 and self.mode != 2: # Only sleep on the Clock or Now Playing screens
+      return
+    timeout = self.awakeSince + self.config.get('settings', 'timeout', 9, int)
+    if self.now >= timeout:
+      self.backlight.off()
+    if self.backlight.state:
+      self.sleepAt = timeout
+
+# Apply a recorded list of events to a fresh AppState, for checking what
+# the app does without the hardware or network.  The replay acts on the
+# given config and backlight (build that on a FakeSysfs) and taps are
+# found in grids (by default the app's).  Returns the AppState and a
+# (time, mode, notice) trace after each event.  The app's own state is
+# put back afterwards.
+def Replay(events, backlight, config, duration=7, grids=None):
+  global app
+  saved = app
+  app   = AppState(events[0].time if events else 0, backlight,
+                   NotificationQueue(), config, grids or hitGrids, duration)
+  trace = []
+  try:
+    for event in events:
+      app.apply(event)
+      trace.append((event.time, app.mode, app.notice))
+  finally:
+    replayed, app = app, saved
+  return replayed, trace
+
+# Benchmarks ---------------------------------------------------------------
+# Benchmark replays scripted scenarios through a fresh AppState and the
+# Renderer on a Headless backend (python screen.py --bench), drawing a
+# frame after each step as the main loop would.  Taps and the tact switch
+# are injected through the backend and come back through an
+# InputDispatcher, as on the Pi.  For every scenario and screen mode it
+# reports the render time per frame, the objects allocated per frame
+# (net, as counted by the garbage collector) and the pixels pushed to the
+# display, so drawing regressions show up off the Pi; check() lists any
+# scenario and mode that drew nothing.  Replayed time starts on a minute
+# boundary, so runs are repeatable.  The steps of processing a cover are
+# timed too, against the plain scale they replaced and the per-frame cost
+# of drawing the result, as is finding the Button under a tap, by HitGrid
+# and by the linear scan it replaced.
+
+class Benchmark:
+  def __init__(self, backend, renderer, config):
+    self.backend   = backend
+    self.renderer  = renderer
+    self.config    = config
+    self.backlight = backend.backlight(config)
+    self.duration  = config.get('settings', 'overlay', 7, int)
+    self.start     = 1500000000
+    self.name      = None
+    self.now       = self.start # Replayed time of input being dispatched
+    self.expected  = collections.OrderedDict() # Scenario -> modes it draws
+    self.results   = collections.OrderedDict() # (scenario, mode) -> [(ms, objects, pixels)]
+    self.steps     = collections.OrderedDict() # Cover step -> average ms
+    self.hits      = collections.OrderedDict() # Hit test -> average us per tap
+    self.dispatcher = InputDispatcher()
+    self.dispatcher.on(MOUSEBUTTONDOWN, lambda event: app.apply(TapEvent(self.now, event.pos)))
+    self.dispatcher.on(TFTBUTTONCLICK,  lambda event: app.apply(ButtonEvent(self.now, event.button)))
+
+  def run(self):
+    self.scenario("clock idle",   self.clockIdle,   [0])
+    self.scenario("track change", self.trackChange, [2])
+    self.scenario("marquee",      self.marquee,     [2])
+    self.scenario("push burst",   self.pushBurst,   [0])
+    self.scenario("keypad entry", self.keypadEntry, [1, 5])
+    self.scenario("tact switch",  self.tactSwitch,  [0])
+    self.coverSteps()
+    self.hitSteps()
+    return self.results
+
+  # The scenarios and modes that drew no frames or pushed no pixels
+  def check(self):
+    missing = []
+    for name, modes in self.expected.iteritems():
+      for mode in modes:
+        frames = self.results.get((name, mode), [])
+        if not sum(f[2] for f in frames):
+          missing.append((name, mode))
+    return missing
+
+  def scenario(self, name, script, modes):
+    global app
+    self.expected[name] = modes
+    saved     = app
+    app       = AppState(self.start, self.backlight, NotificationQueue(),
+                         self.config, hitGrids, self.duration)
+    self.name = name
+    self.backlight.on()
+    self.renderer.invalidate()
+    try:
+      script(self.start)
+    finally:
+      app = saved
+
+  # Bring the state up to now and draw, timing the frame
+  def frame(self, now):
+    app.apply(TickEvent(now))
+    if not self.backlight.state: return # Nothing's drawn while asleep
+    pixels = self.backend.pixels
+    gc.disable()
+    count  = gc.get_count()[0]
+    start  = time.time()
+    self.renderer.render(scenes[app.mode])
+    ms     = (time.time() - start) * 1000
+    count  = gc.get_count()[0] - count
+    gc.enable()
+    self.results.setdefault((self.name, app.mode), []).append(
+      (ms, count, self.backend.pixels - pixels))
+
+  # Dispatch the input injected into the backend, at now
+  def input(self, now):
+    self.now = now
+    self.dispatcher.wait()
+
+  # Ten minutes on the clock, waking every ten seconds
+  def clockIdle(self, now):
+    for i in range(61):
+      self.frame(now + i * 10)
+
+  # Three tracks, each drawn before and after its cover arrives
+  def trackChange(self, now):
+    for i, title in enumerate(("First", "Second", "Third")):
+      t   = now + i * 60
+      url = self.cover(i)
+      app.apply(NowPlayingEvent(t, NowPlaying("Artist", "Album", title + " Track", url)))
+      self.frame(t)
+      deadline = time.time() + 10
+      while covers.get(url) is None and time.time() < deadline:
+        time.sleep(0.01)
+      self.frame(t + 1)
+      self.frame(t + 2)
+
+  # Ten seconds of a title too long for its box scrolling, frame by frame
+  def marquee(self, now):
+    app.apply(NowPlayingEvent(now, NowPlaying("Artist", "Album",
+      "A Track Whose Title Is Far Too Long To Fit", self.cover(0))))
+    t = now
+    while t < now + 10:
+      self.frame(t)
+      t = self.renderer.due(t)
+
+  # 20 pushes from different devices at once, shown as one
+  def pushBurst(self, now):
+    for i in range(20):
+      app.apply(NoticeEvent(now + i * 0.05, "push",
+        {'type': 'note', 'title': "Push %d" % (i + 1),
+         'body': "Body of push %d" % (i + 1)}, "device%d" % i))
+    t = now + 1
+    while True:
+      self.frame(t)
+      if not app.notice: break
+      t = app.noticeExpires
+
+  # From the clock into settings, then typing a new backlight timeout
+  def keypadEntry(self, now):
+    keys    = dict((b.value, b) for b in buttons[5])
+    presses = [buttons[0][0], buttons[1][1]] + [keys[v] for v in (1, 2, 0, 10, 0, 12)]
+    for i, button in enumerate(presses):
+      self.backend.tap(button.rect.center)
+      self.input(now + i)
+      self.frame(now + i)
+
+  # The tact switch turning the backlight off and on again, twice
+  def tactSwitch(self, now):
+    for i in range(4):
+      self.backend.press()
+      self.input(now + i)
+      self.frame(now + i)
+
+  # Each step of processing a 300x300 cover, runs times
+  def coverSteps(self, runs=20):
+    bitmap = pygame.image.load(self.cover(0)[len('file://'):])
+    cover  = covers.process(bitmap)[0]
+    pixels = pygame.surfarray.array3d(bitmap).astype(float)
+    steps  = [("plain scale", lambda: convertBitmap(pygame.transform.scale(bitmap, covers.size))),
+              ("process",     lambda: covers.process(bitmap)),
+              ("area scale",  lambda: areaScale(pixels, covers.size)),
+              ("dither",      lambda: ditherRGB565(pixels)),
+              ("backdrop",    lambda: coverBackdrop(pixels, covers.backdropSize)),
+              ("blit cover",  lambda: self.renderer.screen.blit(cover, (19, 48)))]
+    for name, step in steps:
+      start = time.time()
+      for i in range(runs):
+        step()
+      self.steps[name] = (time.time() - start) * 1000 / runs
+
+  # Finding the Button under each of taps random taps on every screen
+  def hitSteps(self, taps=1000):
+    rng   = random.Random(0)
+    taps  = [(rng.randrange(320), rng.randrange(240)) for i in range(taps)]
+    steps = [("hit grid",    lambda: [grid.hit(pos) for grid in hitGrids for pos in taps]),
+             ("linear scan", lambda: [next((b for b in grid.buttons if b.contains(pos)), None)
+                                      for grid in hitGrids for pos in taps])]
+    for name, step in steps:
+      start = time.time()
+      step()
+      self.hits[name] = (time.time() - start) * 1e6 / (len(taps) * len(hitGrids))
+
+  # A generated album cover, as a file:// URL for the CoverFetcher
+  def cover(self, i):
+    path = os.path.join(self.backend.path, 'cover%d.png' % i)
+    if not os.path.exists(path):
+      bitmap = pygame.Surface((300, 300))
+      bitmap.fill((60 * i, 120, 200))
+      pygame.draw.circle(bitmap, (255, 255 - 60 * i, 0), (150, 150), 100)
+      pygame.image.save(bitmap, path)
+    return 'file://' + path
+
+  def report(self):
+    print "%-14s %4s %6s %8s %8s %8s %8s %8s" % (
+      "scenario", "mode", "frames", "avg ms", "p95 ms", "max ms", "objects", "pixels")
+    for (name, mode), frames in self.results.iteritems():
+      ms = sorted(f[0] for f in frames)
+      n  = len(frames)
+      print "%-14s %4d %6d %8.2f %8.2f %8.2f %8.1f %8d" % (
+        name, mode, n, sum(ms) / n, ms[min(n - 1, int(n * 0.95))], ms[-1],
+        sum(f[1] for f in frames) / float(n), sum(f[2] for f in frames) // n)
+    print
+    print "%-14s %8s" % ("cover step", "avg ms")
+    for name, ms in self.steps.iteritems():
+      print "%-14s %8.2f" % (name, ms)
+    print
+    print "%-14s %8s" % ("hit test", "avg us")
+    for name, us in self.hits.iteritems():
+      print "%-14s %8.2f" % (name, us)
+    for name, mode in self.check():
+      print "%s drew nothing in mode %d" % (name, mode)
+
+# A Benchmark on a Headless backend, with scratch files under path, set
+# up as the startup sets the app up (for --bench and the tests)
+def HeadlessBenchmark(path=None):
+  backend  = Headless(path)
+  renderer = Renderer(backend.open(), [NotificationPanel()], backend.update)
+  config   = ConfigStore(os.path.join(backend.path, 'config.json'), {
+    'pushbullet': {'mirroring': "off"},
+    'settings':   {'backlight': "on", 'timeout': 3600, 'overlay': 7}})
+  backend.buttons(TFTBtn2Click)
+  loadIcons()
+  covers.path = os.path.join(backend.path, 'covers')
+  covers.start()
+  return Benchmark(backend, renderer, config)
 
 # UI callbacks -------------------------------------------------------------
 # These are defined before globals because they're referenced by items in
@@ -132,70 +2542,103 @@ def testCallback():
   log("test", "INFO")
 
 def screenCallback(n): # Switch to a screen mode
-  global screenMode
   if n is 5:
-    global config, numberstring
-    numberstring = str(config['settings']['timeout'])
-  screenMode = n
+    app.numberstring = str(app.config.get('settings', 'timeout'))
+  if n is 3 and app.mode == 2: # Into the history from Now Playing, at the top
+    app.historyPage = 0
+  if n is 6 and app.mode == 1: # Into the notifications from Settings, likewise
+    app.noticePage = 0
+  app.mode = n
+
+def historyCallback(n): # Show the details of the nth track on the page
+  tracks = history.page(app.historyPage * historyRows + n, 1) if history else []
+  if tracks:
+    app.historyTrack = tracks[0]
+    app.historyPlays = history.plays(tracks[0].artist, tracks[0].title)
+    app.mode = 4
+
+def pageCallback(n): # Page the history back or forward
+  page = app.historyPage + n
+  if page >= 0 and history and page * historyRows < history.count():
+    app.historyPage = page
+
+def noticePageCallback(n): # Page the notification history back or forward
+  page = app.noticePage + n
+  if page >= 0 and notificationLog and page * historyRows < notificationLog.count():
+    app.noticePage = page
 
 def clockCallback(): # Enable backlight if off, show settings if on
-  global screenMode, backlight, config, sleep
-  if config['settings']['backlight'] == "on":
-    screenMode = 1
-  elif config['settings']['backlight'] == "off":
-    backlight.on()
-    sleep = 0
+  if app.config.get('settings', 'backlight') == "on":
+    app.mode = 1
+  elif app.config.get('settings', 'backlight') == "off":
+    app.backlight.on()
+    app.awakeSince = app.now
 
 def nowPlayingCallback(): # Enable/disable backlight
-  global backlight, config, sleep
-  if config['settings']['backlight'] == "on":
-    backlight.off()
-  elif config['settings']['backlight'] == "off":
-    backlight.on()
-    sleep = 0
+  if app.config.get('settings', 'backlight') == "on":
+    app.backlight.off()
+  elif app.config.get('settings', 'backlight') == "off":
+    app.backlight.on()
+    app.awakeSince = app.now
 
 def mainCallback(): # Exit settings
-	global screenMode
-	screenMode = 0 # Switch back to main window
+	app.mode = 0 # Switch back to main window
 
 def backlightCallback(): # Enable/disable backlight and save to config
-  global config, backlight
-  if config['settings']['backlight'] == "on":
-    backlight.off()
-    config['settings']['backlight'] = "off"
-  elif config['settings']['backlight'] == "off":
-    backlight.on()
-    config['settings']['backlight'] = "on"
-  saveConfig()
+  toggleBacklight()
 
 def timeoutCallback(n): # Numerical input for timeout
-  global screenMode, numberstring, config
   if n < 10:
-    numberstring = numberstring + str(n)
+    app.numberstring = app.numberstring + str(n)
   elif n == 10:
-    numberstring = numberstring[:-1]
+    app.numberstring = app.numberstring[:-1]
   elif n == 11:
-    screenMode = 1
+    app.mode = 1
   elif n == 12:
-    screenMode = 1
-    config['settings']['timeout'] = numberstring
-    saveConfig()
+    app.mode = 1
+    app.config.set('settings', 'timeout', int(app.numberstring or 0))
 
 def mirroringCallback():
-  global config
-  if config['pushbullet']['mirroring'] == "on":
-    config['pushbullet']['mirroring'] = "off"
-  elif config['pushbullet']['mirroring'] == "off":
-    config['pushbullet']['mirroring'] = "on"
-  saveConfig()
+  if app.config.get('pushbullet', 'mirroring') == "on":
+    app.config.set('pushbullet', 'mirroring', "off")
+  elif app.config.get('pushbullet', 'mirroring') == "off":
+    app.config.set('pushbullet', 'mirroring', "on")
+
+# Lines for the history screens' PagedLists
+def scrobbleLines(offset, count):
+  if not history: return []
+  return [(t.time, t.artist + " - " + t.title) for t in history.page(offset, count)]
+
+def noticeLines(offset, count):
+  if not notificationLog: return []
+  lines = []
+  for n in notificationLog.page(offset, count):
+    if n is None: continue
+    text = (n.data.get('title') or n.data.get('body') or n.data.get('url') or
+            n.data.get('file_name') or n.data.get('application_name') or n.kind)
+    lines.append((n.time, text.splitlines()[0] if text.strip() else n.kind))
+  return lines
 
 # Global stuff -------------------------------------------------------------
-screenMode      =  0      # Current screen mode; default = viewfinder
-screenModePrior = -1      # Prior screen mode (for detecting changes)
+metrics         = Metrics() # Counters, gauges and histograms for monitoring
+httpBuckets     = [50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')] # ms
+app             = None    # AppState, created at startup
 iconPath        = 'icons' # Subdirectory containing UI bitmaps (PNG format)
-sleep           = 0       # Seconds counter for backlight timeout
-icons           = []      # This list gets populated at startup
-numberstring    = "0"     # Backlight timer numerical input
+assets          = Assets(iconPath) # This gets populated at startup
+events          = Queue.Queue() # Events posted by background threads
+TFTBUTTONCLICK  = USEREVENT + 1 # Tact switch pressed (posted from GPIO thread)
+TIMEREVENT      = USEREVENT + 2 # Scheduler's wake-up timer
+WAKEEVENT       = USEREVENT + 3 # Background thread has something to show
+fonts           = Fonts()     # Every font face/size, opened once
+textCache       = TextCache() # Rendered text surfaces, least recently used first
+notices         = NotificationQueue() # Pushes and notifications waiting to be shown
+mirrorIcons     = MirrorIcons() # Decoded notification icons, by app
+covers          = CoverFetcher() # Album covers, fetched in the background
+history         = None    # ScrobbleHistory, created at startup
+notificationLog = None    # NotificationLog, opened at startup
+pushbullet      = None    # PushbulletAPI, likewise
+pbStream        = None    # PushbulletStream, likewise
+historyRows     = 4       # Lines per page of the history screens
 
 # buttons[] is a list of lists; each top-level list element corresponds
 # to one screen mode, and each element within those lists corresponds to one UI button.
@@ -211,17 +2654,23 @@ buttons = [
    Button((260,120, 60, 60), bg='cog',   cb=mirroringCallback),
    Button((  0,180,160, 60), bg='ok',    cb=mainCallback),
    Button((160,180, 70, 60), bg='left',  cb=testCallback),
-   Button((230,180, 70, 60), bg='right', cb=testCallback)],
+   Button((230,180, 70, 60), bg='right', cb=screenCallback, value=6)],
 
   # 2 - Now Playing
   [Button((  0,   0, 320, 180),           cb=nowPlayingCallback),
    Button((130, 180,  60,  60), bg='cog', cb=screenCallback, value=3)],
 
-  # 3 - Track info
-  [Button(( 90, 180, 140,  60), bg='ok', cb=screenCallback, value=2)],
+  # 3 - Scrobble history
+  [Button((  0,  44, 320,  32),             cb=historyCallback, value=0),
+   Button((  0,  76, 320,  32),             cb=historyCallback, value=1),
+   Button((  0, 108, 320,  32),             cb=historyCallback, value=2),
+   Button((  0, 140, 320,  32),             cb=historyCallback, value=3),
+   Button(( 15, 180,  60,  60), bg='left',  cb=pageCallback,    value=-1),
+   Button(( 90, 180, 140,  60), bg='ok',    cb=screenCallback,  value=2),
+   Button((245, 180,  60,  60), bg='right', cb=pageCallback,    value=1)],
 
-  # 4 - Pushbullet push
-  [],
+  # 4 - Track info (from the history)
+  [Button(( 90, 180, 140,  60), bg='ok', cb=screenCallback, value=3)],
 
   # 5 - Backlight timeout numerical input
   [Button((  0,  0,320, 60), bg='box'),
@@ -239,42 +2688,291 @@ buttons = [
    Button((180,180,140, 60), bg='ok',    cb=timeoutCallback, value=12),
    Button((180, 60,140, 60), bg='cancel',cb=timeoutCallback, value=11)],
 
-  # 6 - Pushbullet notification mirror
-  []
+  # 6 - Notification history
+  [Button(( 15, 180,  60,  60), bg='left',  cb=noticePageCallback, value=-1),
+   Button(( 90, 180, 140,  60), bg='ok',    cb=screenCallback,     value=1),
+   Button((245, 180,  60,  60), bg='right', cb=noticePageCallback, value=1)]
+]
+
+# hitGrids[] indexes each screen mode's buttons for finding taps
+hitGrids = [HitGrid(b) for b in buttons]
+
+# scenes[] parallels buttons[]; each screen mode's Scene is its buttons
+# followed by the widgets showing that mode's content.  An opaque
+# Backdrop goes first of all, so the buttons are drawn over it.
+
+scenes = [
+
+  # 0 - Clock
+  Scene(buttons[0] + [ClockFace()]),
+
+  # 1 - Settings
+  Scene(buttons[1] +
+   [Label(( 10, 10), "Backlight:", size=30),
+    Label(( 10, 70), "Timeout:",   size=30),
+    Label(( 10,130), "Mirroring:", size=30),
+    Label((130, 10), lambda: app.config.get('settings', 'backlight'), size=30),
+    Label((130, 70), lambda: str(app.config.get('settings', 'timeout')) + " seconds", size=30),
+    Label((130,130), lambda: str(app.config.get('pushbullet', 'mirroring')), size=30)]),
+
+  # 2 - Now Playing
+  Scene([Backdrop(lambda: app.track.cover, 'nowplaying')] + buttons[2] +
+   [Image(( 19,  8), 'lastfm'),
+    Cover(( 19, 48, 115, 115), lambda: app.track.cover),
+    Label((160, 20), "Now Scrobbling", center=True),
+    Marquee((145, 72, 165, 24), lambda: app.track.artist),
+    Marquee((145,102, 165, 24), lambda: app.track.album),
+    Marquee((145,132, 165, 24), lambda: app.track.title)]),
+
+  # 3 - Scrobble history
+  Scene(buttons[3] +
+   [Image((  0,  0), 'nowplaying'),
+    Image(( 19,  8), 'lastfm'),
+    Label((160, 20), "Recent Tracks", center=True),
+    PagedList((0, 44, 320, 128), lambda: (app.historyPage, app.historyVersion),
+              scrobbleLines, historyRows)]),
+
+  # 4 - Track info (from the history)
+  Scene(buttons[4] +
+   [Image((  0,  0), 'nowplaying'),
+    Image(( 19,  8), 'lastfm'),
+    Label((160, 20), "Track Info", center=True),
+    Marquee(( 10, 48, 300, 24), lambda: app.historyTrack.title),
+    Marquee(( 10, 74, 300, 24), lambda: app.historyTrack.artist),
+    Marquee(( 10,100, 300, 24), lambda: app.historyTrack.album),
+    Label(( 10,126), lambda: time.strftime("%a %d %b %Y, %H:%M",
+                                           time.localtime(app.historyTrack.time))),
+    Label(( 10,152), lambda: "Scrobbled %d time%s" % (app.historyPlays,
+                                                       "" if app.historyPlays == 1 else "s"))]),
+
+  # 5 - Backlight timeout numerical input
+  Scene(buttons[5] + [Label((10, 2), lambda: app.numberstring, size=50)]),
+
+  # 6 - Notification history
+  Scene(buttons[6] +
+   [Image((  0,  0), 'nowplaying'),
+    Image(( 19,  8), 'pb'),
+    Label((160, 20), "Notifications", center=True),
+    PagedList((0, 44, 320, 128), lambda: (app.noticePage, app.noticesLogged),
+              noticeLines, historyRows)])
 ]
 
 
 # Assorted utility functions -----------------------------------------------
 def TFTBtn2Click(channel):
-  pygame.event.post(click2event)
-
-# Run on a separate thread, CheckInputs() never stops checking touchscreen
-# and tac switch input, sleeping for 0.8s at the end of each loop to reduce
-# CPU usage.
-def CheckInputs():
-  global config
-  while True:
-    for event in pygame.event.get():
-      if event.type is MOUSEBUTTONDOWN:
-        pos = pygame.mouse.get_pos()
-        for b in buttons[screenMode]:
-          if b.selected(pos): break
-
-      if event.type is TFTBUTTONCLICK:
-        if event.button is 2:
-          if config['settings']['backlight'] == "on":
-            backlight.off()
-            config['settings']['backlight'] = "off"
-          elif config['settings']['backlight'] == "off":
-            backlight.on()
-            config['settings']['backlight'] = "on"
-          saveConfig()
-    time.sleep(0.8)
-
-# Collect user input to create a fresh config file
+  pygame.event.post(pygame.event.Event(TFTBUTTONCLICK, button=2, t=time.time()))
+
+# Wake the main loop from a background thread, e.g. when there's something
+# new to show
+def wake():
+  pygame.event.post(pygame.event.Event(WAKEEVENT))
+
+# Hand an event from a background thread to the main loop, to be applied
+# to the AppState
+def post(event):
+  events.put(event)
+  wake()
+
+# Event handlers, run on the main thread by the InputDispatcher ------------
+
+def OnTap(event):
+  app.apply(TapEvent(time.time(), event.pos))
+
+def OnTFTButton(event):
+  app.apply(ButtonEvent(event.t, event.button))
+
+# SDL turns SIGTERM (from systemd or kill) into a QUIT event, waking the
+# main loop.  atexit doesn't run when a signal kills the process, so save
+# any preferences still waiting on the ConfigStore's timer, then exit.
+def OnQuit(event):
+  log("Quitting...", "INFO")
+  config.flush()
+  sys.exit(0)
+
+# Switch the backlight on/off and save the preference
+def toggleBacklight():
+  if app.config.get('settings', 'backlight') == "on":
+    app.backlight.off()
+    app.config.set('settings', 'backlight', "off")
+  elif app.config.get('settings', 'backlight') == "off":
+    app.backlight.on()
+    app.config.set('settings', 'backlight', "on")
+
+# Load all the icons, and assign them to the Buttons that use them
+def loadIcons():
+  log("Loading icons...", "INFO")
+  assets.load()
+  log("Assigning buttons...", "INFO")
+  for s in buttons:        # For each screenful of buttons...
+    for b in s:            #  For each button on screen...
+      if b.bg:             #   Look up Icons by name; match?
+        b.iconBg = assets.get(b.bg) # Assign Icon to Button
+        if b.iconBg: b.bg = None    # Name no longer used; allow garbage collection
+      if b.fg:
+        b.iconFg = assets.get(b.fg)
+        if b.iconFg: b.fg = None
+
+# Convert a freshly loaded bitmap to the display's pixel format.  Only
+# bitmaps with transparent pixels keep their alpha channel; fully opaque
+# ones are converted to the display depth outright, which blits fastest.
+def convertBitmap(bitmap):
+  if bitmap.get_flags() & SRCALPHA:
+    w, h = bitmap.get_size()
+    if pygame.mask.from_surface(bitmap, 254).count() < w * h:
+      return bitmap.convert_alpha()
+  return bitmap.convert()
+
+# Weights for resampling n pixels to m by area averaging: row i holds the
+# share of each source pixel in the area destination pixel i covers
+def areaWeights(n, m):
+  edges   = numpy.arange(m + 1) * (n / float(m))
+  first   = numpy.arange(n)
+  weights = (numpy.minimum(edges[1:, None], first + 1) -
+             numpy.maximum(edges[:-1, None], first)).clip(0)
+  return weights / weights.sum(axis=1)[:, None]
+
+# Scale pixels (a surfarray (width, height, 3) array) to size, each
+# destination pixel the average of the area of the source it covers (so
+# nothing is skipped, unlike transform.scale)
+def areaScale(pixels, size):
+  pixels = numpy.tensordot(areaWeights(pixels.shape[0], size[0]), pixels, (1, 0))
+  pixels = numpy.tensordot(areaWeights(pixels.shape[1], size[1]), pixels, (1, 1))
+  return pixels.transpose(1, 0, 2)
+
+# Dither pixels (0-255, float) to RGB565 with an 8x8 Bayer matrix.  The
+# result is 8-bit, but every value converts to 16 bits exactly, so the
+# levels lost on the 16-bit display make a fine fixed pattern, not bands.
+def ditherRGB565(pixels):
+  bayer = numpy.zeros((1, 1))
+  while len(bayer) < 8:
+    bayer = numpy.vstack((numpy.hstack((4 * bayer,     4 * bayer + 2)),
+                          numpy.hstack((4 * bayer + 3, 4 * bayer + 1))))
+  w, h      = pixels.shape[:2]
+  threshold = numpy.tile((bayer + 0.5) / 64, (w // 8 + 1, h // 8 + 1))[:w, :h]
+  dithered  = numpy.empty(pixels.shape, numpy.uint8)
+  for channel, bits in enumerate((5, 6, 5)):
+    top   = (1 << bits) - 1
+    level = numpy.floor(pixels[:, :, channel] * (top / 255.0) + threshold)
+    level = numpy.minimum(level, top).astype(numpy.uint8)
+    dithered[:, :, channel] = (level << (8 - bits)) | (level >> (2 * bits - 8))
+  return dithered
+
+# A blurred, darkened backdrop of size from a cover's pixels: the middle
+# of the cover in the backdrop's shape is shrunk to an eighth, box
+# blurred, scaled back up smoothly, darkened so text stays readable atop
+# it, and dithered
+def coverBackdrop(pixels, size, darken=0.45):
+  w, h   = pixels.shape[:2]
+  cw, ch = min(w, h * size[0] // size[1]), min(h, w * size[1] // size[0])
+  x, y   = (w - cw) // 2, (h - ch) // 2
+  small  = areaScale(pixels[x:x + cw, y:y + ch], (size[0] // 8, size[1] // 8))
+  sw, sh = small.shape[:2]
+  for i in range(2):
+    padded = numpy.pad(small, ((1, 1), (1, 1), (0, 0)), 'edge')
+    small  = sum(padded[dx:dx + sw, dy:dy + sh] for dx in range(3) for dy in range(3)) / 9
+  small = pygame.surfarray.make_surface(small.astype(numpy.uint8))
+  large = pygame.surfarray.array3d(pygame.transform.smoothscale(small, size))
+  return ditherRGB565(large * darken)
+
+# Write a value to a (sysfs) file in one go
+def writeFile(path, value):
+  with open(path, 'w') as f:
+    f.write(value)
+
+# Bytes of pixel data held by a surface
+def surfaceBytes(surface):
+  return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+# Get a track's album name and cover URL from one track.getInfo request
+# (pylast's get_album() and get_cover_image() make a request each)
+def trackInfo(track):
+  album = " "
+  cover = False
+  try:
+    doc = track._request(track.ws_prefix + ".getInfo", True)
+  except pylast.WSError: # Last.fm doesn't know the track
+    return (album, cover)
+  albums = doc.getElementsByTagName("album")
+  if albums:
+    album  = pylast._extract(albums[0], "title") or " "
+    images = pylast._extract_all(albums[0], "image")
+    if len(images) > pylast.COVER_LARGE:
+      cover = images[pylast.COVER_LARGE] or False
+  return (album, cover)
+
+# Text layout.  fitText() ellipsizes text to fit width pixels in font;
+# wrapText() breaks it into at most lines lines (at spaces where it can,
+# keeping the text's own line breaks), ellipsizing the last one if there
+# isn't room for all of it.  Both measure with a binary search over
+# prefixes rather than trying every length.
+def fitText(font, text, width, cut=False):
+  if not cut and font.size(text)[0] <= width:
+    return text
+  n = fitLength(font, text, width, "...")
+  return text[:n].rstrip() + "..."
+
+def wrapText(font, text, width, lines):
+  out = []
+  for para in text.splitlines():
+    line = ""
+    for word in para.split():
+      joined = line + " " + word if line else word
+      if font.size(joined)[0] <= width:
+        line = joined
+        continue
+      if line: out.append(line)
+      line = word
+      while font.size(line)[0] > width: # Break words too long for a line
+        n = max(fitLength(font, line, width), 1)
+        out.append(line[:n])
+        line = line[n:]
+    out.append(line)
+  if len(out) > lines > 0:
+    out = out[:lines - 1] + [fitText(font, " ".join(out[lines - 1:]), width,
+                                     cut=True)]
+  return out[:max(lines, 0)]
+
+# Length of the longest prefix of text that fits width with suffix added
+def fitLength(font, text, width, suffix=""):
+  lo, hi = 0, len(text)
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if font.size(text[:mid] + suffix)[0] <= width: lo = mid
+    else:                                          hi = mid - 1
+  return lo
+
+# Time the with block into a Histogram, in ms
+@contextlib.contextmanager
+def timed(histogram):
+  start = time.time()
+  try:
+    yield
+  finally:
+    histogram.add((time.time() - start) * 1000)
+
+# Prometheus label set text for (name, value) pairs, e.g. {service="lastfm"}
+def labelText(labels):
+  if not labels: return ""
+  return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                        .replace('"', '\\"').replace('\n', '\\n'))
+                        for name, value in labels) + "}"
+
+# Clip rects to bounds and merge any that overlap, so no pixel is
+# redrawn or pushed to the display twice in one frame
+def mergeRects(rects, bounds):
+  merged = []
+  for r in rects:
+    r = r.clip(bounds)
+    if r.w == 0 or r.h == 0: continue
+    i = r.collidelist(merged)
+    while i != -1:
+      r = r.union(merged.pop(i))
+      i = r.collidelist(merged)
+    merged.append(r)
+  return merged
+
+# Collect user input for a fresh config, returned as a dict
 def CreateConfig():
-  global config
-
   log("A configuration file was not found. Let's create one.", "WARN")
   LAST_KEY        = None
   LAST_SECRET     = None
@@ -302,7 +3000,7 @@ def CreateConfig():
       else:
         break
 
-  config = {
+  return {
     'lastfm': {
       'API_KEY':     LAST_KEY,
       'API_SECRET':  LAST_SECRET,
@@ -315,375 +3013,220 @@ def CreateConfig():
     },
     'settings': {
       'backlight':   "on",
-      'timeout':     "9"
-    }
-  }
-  with open('config.json', 'w') as outfile:
-    json.dump(config, outfile, indent=2)
-
-# Write the current configuration and preferences (which should
-# always be up to date in config) to config.json
-def saveConfig():
-  towrite   = {
-    'lastfm': {
-      'API_KEY':     config['lastfm']['API_KEY'],
-      'API_SECRET':  config['lastfm']['API_SECRET'],
-      'username':    config['lastfm']['username'],
-      'password':    config['lastfm']['password']
-    },
-    'pushbullet': {
-      'API_KEY':     config['pushbullet']['API_KEY'],
-      'mirroring':   config['pushbullet']['mirroring']
-    },
-    'settings': {
-      'backlight':   config['settings']['backlight'],
-      'timeout':     config['settings']['timeout']
+      'timeout':     9,
+      'poll':        5,
+      'overlay':     7
     }
   }
-  with open('config.json', 'w') as outfile:
-    json.dump(towrite, outfile, indent=2)
 
 # Log a message with a timestamp to the console window
 def log(logmsg, type):
   timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
   print "[{0}] [{1}] {2}".format(timestamp, type, logmsg)
-
-# Run on a separate thread, InitPB() connects to the Pushbullet
-# websocket, and keeps the connection open forever
-def InitPB():
-  websocket.enableTrace(False)
-  ws = websocket.WebSocketApp("wss://stream.pushbullet.com/websocket/" + config['pushbullet']['API_KEY'], on_message = OnPBMessage)
-  ws.on_open = OnPBStart
-  ws.run_forever()
+  metrics.counter('log_messages_total', "Messages logged, by level", level=type).inc()
 
 # When a connection to the Pushbullet websocket is established,
-# log and get all available Pushbullet devices
+# log and get all available Pushbullet devices (if not already known).
+# After a reconnect, catch up on pushes sent while we were disconnected.
 def OnPBStart(ws):
-  global PbDevices
   log("Connected to Pushbullet WebSocket", "INFO")
-  r = requests.get("https://api.pushbullet.com/v2/devices", auth=(config['pushbullet']['API_KEY'], ''))
-  PbDevices = r.json()['devices']
+  pushbullet.getDevices()
+  if pbStream.reconnects:
+    QueueNewPushes(pbStream.connected)
+
+# Fetch pushes we haven't seen yet and queue them to be shown.  arrived
+# is when the stream told us about them, which the display latency is
+# measured from, so it includes fetching them.
+def QueueNewPushes(arrived):
+  for push in reversed(pushbullet.newPushes()):
+    if push.get('active', True) and push.get('type'):
+      source = push.get('source_device_iden')
+      if notificationLog.append("push", push, source, arrived): # Not seen before
+        post(NoticeEvent(arrived, "push", push, source))
+
+# Connect to Last.fm and start polling it (run in the background at
+# startup; this is where pylast is first imported).  Logging in needs the
+# network, so it's retried, backing off, until it works.
+def StartLastfm():
+  global history
+  delay = 5
+  while True:
+    log("Connecting to Last.fm...", "INFO")
+    try:
+      network = pylast.LastFMNetwork(api_key       = config.get('lastfm', 'API_KEY'),
+                                     api_secret    = config.get('lastfm', 'API_SECRET'),
+                                     username      = config.get('lastfm', 'username'),
+                                     password_hash = config.get('lastfm', 'password'))
+      break
+    except (pylast.NetworkError, pylast.MalformedResponseError) as e:
+      log("Failed to connect to Last.fm, retrying in %ds: %s" % (delay, e), "ERROR")
+      time.sleep(delay)
+      delay = min(delay * 2, 300)
+  user    = network.get_user("dudeman1996")
+  history = ScrobbleHistory("cache/history.db", user)
+  history.start()
+  poller  = NowPlayingPoller(user, config.get('settings', 'poll', 5, int),
+                             history=history)
+  post(PollerEvent(time.time(), poller)) # For the main thread to idle it
+  poller.start()
+
+# Connect to Pushbullet and start the websocket thread (run in the
+# background at startup, like StartLastfm())
+def StartPushbullet():
+  global pushbullet, pbStream
+  log("Connecting to Pushbullet...", "INFO")
+  websocket.enableTrace(False)
+  pushbullet = PushbulletAPI(config.get('pushbullet', 'API_KEY'),
+                             config.get('pushbullet', 'api'))
+  pbStream   = PushbulletStream(
+    config.get('pushbullet', 'stream', "wss://stream.pushbullet.com/websocket/") +
+    config.get('pushbullet', 'API_KEY'), OnPBMessage, OnPBStart)
+  pbStream.start()
+
+# When this process started, so startup times include the interpreter
+# and imports; from /proc on Linux, otherwise it's taken to be now
+def processStart():
+  try:
+    with open('/proc/self/stat') as f:
+      ticks = float(f.read().rsplit(')', 1)[1].split()[19]) # starttime
+    with open('/proc/uptime') as f:
+      uptime = float(f.read().split()[0])
+    return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+  except (IOError, OSError, ValueError, IndexError):
+    return time.time()
 
 # Whenever something happens in the Pushbullet websocket.
-def OnPBMessage(ws, message):
-  global PbMessage, screenMode, PbPrior, config
-  timestamp = time.time()
+def OnPBMessage(ws, message, arrived):
   message   = json.loads(message)
-  if message['type'] == "tickle": # A new push was sent, fetch it!
-    r = requests.get("https://api.pushbullet.com/v2/pushes?modified_after=" + str(time.time() - 100), auth=(config['pushbullet']['API_KEY'], ''))
-    PbMessage = r.json()
-    if PbMessage['pushes'][0]['type']:
-      PbPrior = screenMode
-      screenMode = 4
-  elif message['type'] == "push" and config['pushbullet']['mirroring'] == "on": # A notification happened somewhere, show it if enabled
-    imgdata = base64.b64decode(message['push']['icon']) # The notification icon is encoded in base64, decode it
-    with open("cache/pb-mirror.png", "wb") as f:
-      f.write(imgdata)
-    PbMessage = message['push']
-    PbPrior = screenMode
-    screenMode = 6
+  metrics.counter('pushbullet_messages_total', "Messages from the Pushbullet stream",
+                  type=message.get('type', "")).inc()
+  if message.get('type') == "tickle":
+    if message.get('subtype') == "device": # Devices changed, refresh them
+      pushbullet.getDevices(True)
+    else: # A new push was sent, fetch it (and any others we haven't seen)!
+      QueueNewPushes(arrived)
+  elif message.get('type') == "push" and config.get('pushbullet', 'mirroring') == "on": # A notification happened somewhere, show it if enabled
+    if message.get('push', {}).get('type') != "mirror":
+      return # Dismissals, clipboard and the like have nothing to show
+    push    = dict(message['push'])
+    package = push.get('package_name')
+    push['bitmap'] = mirrorIcons.get(package, push.pop('icon', '')) # The notification icon is encoded in base64, decode it
+    notificationLog.append("mirror", push, package, arrived)
+    post(NoticeEvent(arrived, "mirror", push, package))
 
 # Initialization -----------------------------------------------------------
-
-# Init framebuffer/touchscreen environment variables
-os.putenv('SDL_VIDEODRIVER', 'fbcon')
-os.putenv('SDL_FBDEV'      , '/dev/fb1')
-os.putenv('SDL_MOUSEDRV'   , 'TSLIB')
-os.putenv('SDL_MOUSEDEV'   , '/dev/input/touchscreen')
-
-
-# Init pygame and screen
-log("Initting...", "INFO")
-pygame.init()
-log("Setting mouse invisible...", "INFO")
-pygame.mouse.set_visible(False)
-log("Setting fullscreen...", "INFO")
-modes = pygame.display.list_modes(16)
-screen = pygame.display.set_mode(modes[0], FULLSCREEN, 16)
-
-log("Loading icons...", "INFO")
-# Load all icons at startup.
-for file in os.listdir(iconPath):
-  if fnmatch.fnmatch(file, '*.png'):
-    icons.append(Icon(file.split('.')[0]))
-# Assign Icons to Buttons, now that they're loaded
-log("Assigning buttons...", "INFO")
-for s in buttons:        # For each screenful of buttons...
-  for b in s:            #  For each button on screen...
-    for i in icons:      #   For each icon...
-      if b.bg == i.name: #    Compare names; match?
-        b.iconBg = i     #     Assign Icon to Button
-        b.bg     = None  #     Name no longer used; allow garbage collection
-      if b.fg == i.name:
-        b.iconFg = i
-        b.fg     = None
-
-# Check config
-if os.path.isfile('config.json'):
-  with open('config.json') as infile:
-    config = json.load(infile)
-else:
-  CreateConfig()
-
-# Init pylast
-log("Connecting to Last.fm...", "INFO")
-API_KEY     = config['lastfm']['API_KEY']
-API_SECRET  = config['lastfm']['API_SECRET']
-username    = config['lastfm']['username']
-password    = config['lastfm']['password']
-network     = pylast.LastFMNetwork(api_key = API_KEY, api_secret = API_SECRET, username = username, password_hash = password)
-user        = network.get_user("dudeman1996")
-result      = user.get_now_playing()
-if result: # If scrobbling, get details
-  screenMode = 2
-  artist = result.artist.get_name()
-  try:
-    album = result.get_album().get_name()
-  except:
-    album = " "
-  title = result.get_title()
-  try:
-    cover = result.get_album().get_cover_image(size=2)
-  except:
-    cover = False
-else:
-  title = " "
-
-# Set the second tact switch up
-GPIO.setmode(GPIO.BCM)
-TFTBUTTONCLICK = pygame.USEREVENT + 1
-click2event = pygame.event.Event(TFTBUTTONCLICK, button=2)
-GPIO.setup(22, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.add_event_detect(22, GPIO.FALLING, callback=TFTBtn2Click, bouncetime=200)
-
-# Init the Backlight class
-backlight = Backlight(config)
-
-# Display a blank screen
-screen.fill(0)
-pygame.display.update()
-
-# Start the CheckInputs thread
-inputThread = threading.Thread(target=CheckInputs)
-inputThread.setDaemon(True)
-inputThread.start()
-
-# Start the Pushbullet websocket thread
-PbThread = threading.Thread(target=InitPB)
-PbThread.setDaemon(True)
-PbThread.start()
-
-# Main loop ----------------------------------------------------------------
-log("Begin.", "INFO")
-while(True):
-  screen.fill(0)
-
-  # Overlay buttons on display and update
-  for i,b in enumerate(buttons[screenMode]):
-    b.draw(screen)
-
-  if screenMode is 6: # PB notification mirro
-    backlight.on()
-    myfont  = pygame.font.SysFont("Arial", 20)
-
-    lastimg = pygame.image.load("icons/pb.png")
-    screen.blit(lastimg, (20, 8))
-
-    label           = myfont.render("New Notification!", 1, (255,255,255))
-    textpos         = label.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = 20
-    screen.blit(label, textpos)
-
-    mirror = pygame.image.load("cache/pb-mirror.png")
-    mirrorscaled = pygame.transform.scale(mirror, (72, 72))
-    screen.blit(mirrorscaled, (20, 84))
-
-    label = myfont.render(PbMessage['title'], 1, (255,255,255))
-    screen.blit(label, (102, 110))
-
-    pygame.display.update()
-    screenMode = PbPrior
-    sleep = 0
-    time.sleep(7)
-    screen.fill(0)
-
-  if screenMode is 5: # Numeric input
-    myfont = pygame.font.SysFont("Arial", 50)
-    label = myfont.render(numberstring, 1, (255,255,255))
-    screen.blit(label, (10, 2))
-
-  if screenMode is 4: # PB message
-    backlight.on()
-    push    = PbMessage['pushes'][0]
-    myfont  = pygame.font.SysFont("Arial", 20)
-    y       = 100
-
-    if 'target_device_iden' in push:
-      for device in PbDevices:
-        if device['iden'] == push['target_device_iden']:
-          if 'nickname' in device:
-            to = device['nickname']
-            break
-          elif 'model' in device:
-            to = device['model']
-            break
-
-    label           = myfont.render("New Push!", 1, (255,255,255))
-    textpos         = label.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = 20
-    screen.blit(label, textpos)
-
-    lastimg = pygame.image.load("icons/pb.png")
-    screen.blit(lastimg, (20, 8))
-
-    label           = myfont.render("New " + push['type'] + " from " + push['sender_email_normalized'], 1, (255,255,255))
-    textpos         = label.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = 60
-    screen.blit(label, textpos)
-
-    if to:
-      label           = myfont.render("(To " + to + ")", 1, (255,255,255))
-      textpos         = label.get_rect()
-      textpos.centerx = screen.get_rect().centerx
-      textpos.centery = 80
-      screen.blit(label, textpos)
-
-    if 'title' in push:
-      label = myfont.render(push['title'], 1, (255,255,255))
-      screen.blit(label, (20, y))
-      y += 20
-
-    if 'body' in push:
-      label = myfont.render(push['body'], 1, (255,255,255))
-      screen.blit(label, (20, y))
-      y += 20
-
-    if push['type'] == "link":
-      label = myfont.render(push['url'], 1, (255,255,255))
-      screen.blit(label, (20, y))
-      y += 20
-
-    pygame.display.update()
-    screenMode = PbPrior
-    sleep = 0
-    time.sleep(7)
-    screen.fill(0)
-
-  if screenMode is 3: # Track info
-    bg = pygame.image.load("icons/nowplaying.png")
-    screen.blit(bg, (0,0))
-
-    lastimg = pygame.image.load("icons/lastfm.png")
-    screen.blit(lastimg, (19, 8))
-    
-    myfont = pygame.font.SysFont("Arial", 20)
-
-    label           = myfont.render("Track Info", 1, (255,255,255))
-    textpos         = label.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = 20
-    screen.blit(label, textpos)
-
-  if screenMode is 2: # Now Playing
-    bg = pygame.image.load("icons/nowplaying.png")
-    screen.blit(bg, (0,0))
-
-    lastimg = pygame.image.load("icons/lastfm.png")
-    screen.blit(lastimg, (19, 8))
-    
-    myfont = pygame.font.SysFont("Arial", 20)
-
-    if cover:
-      if not os.path.exists("cache"):
-        os.makedirs("cache")
-      urllib.urlretrieve(cover, "cache/cover.png")
-      coverimg = pygame.image.load("cache/cover.png")
-      coverscaled = pygame.transform.scale(coverimg, (115, 115))
-      screen.blit(coverscaled, (19, 48))
-
-    label = myfont.render("Now Scrobbling", 1, (255,255,255))
-    textpos         = label.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = 20
-    screen.blit(label, textpos)
-
-    label = myfont.render(artist, 1, (255,255,255))
-    screen.blit(label, (145, 72))
-
-    label = myfont.render(album, 1, (255,255,255))
-    screen.blit(label, (145, 102))
-
-    label = myfont.render(title, 1, (255,255,255))
-    screen.blit(label, (145, 132))
-
-  if screenMode is 1: # Settings
-    sleep = 0
-    myfont = pygame.font.SysFont("Arial", 30)
-    label = myfont.render("Backlight:" , 1, (255,255,255))
-    screen.blit(label, (10, 10))
-    label = myfont.render("Timeout:" , 1, (255,255,255))
-    screen.blit(label, (10, 70))
-    label = myfont.render("Mirroring:" , 1, (255,255,255))
-    screen.blit(label, (10,130))
-
-    label = myfont.render(config['settings']['backlight'], 1, (255,255,255))
-    screen.blit(label, (130, 10))
-    label = myfont.render(str(config['settings']['timeout']) + " seconds", 1, (255,255,255))
-    screen.blit(label, (130, 70))
-    label = myfont.render(str(config['pushbullet']['mirroring']) , 1, (255,255,255))
-    screen.blit(label, (130,130))
-
-  if screenMode is 0: # Clock
-    mytime          = time.strftime("%H:%M")
-    myp             = time.strftime("%p")
-    clockfont       = pygame.font.Font("SFDigitalReadout-Medium.ttf", 120)
-    pfont           = pygame.font.SysFont("Arial", 30)
-    clocklabel      = clockfont.render(mytime, 1, [255,255,255])
-    plabel          = pfont.render(myp, 1, [255,255,255])
-    textpos         = clocklabel.get_rect()
-    textpos.centerx = screen.get_rect().centerx
-    textpos.centery = screen.get_rect().centery
-    ppos            = [ textpos[0] + textpos[2] + 10, textpos[1] ]
-    screen.blit(plabel, ppos)
-    screen.blit(clocklabel, textpos) 
-
-  # Update the screen
-  pygame.display.update()
-  screenModePrior = screenMode
-
-  # Check if anything is scrobbling
-  try:
-    result = user.get_now_playing()
-  except:
-    log("Failed to get now playing", "ERROR")
-  if result and screenMode != 3:
-    if title != result.get_title():
-      sleep = 0
-      backlight.on()
-      artist = result.artist.get_name()
-      try:
-        album = result.get_album().get_name()
-      except:
-        album = " "
-      title = result.get_title()
-      try:
-        cover = result.get_album().get_cover_image(size=2)
-      except:
-        cover = False
-    screenMode = 2
-  elif screenMode == 0 or screenMode == 2:
-    if screenModePrior != 0:
-      backlight.on()
-      sleep = 0
-    screenMode = 0
-
-  # Sleep (turn off the backlight) after x seconds defined in the config
-  if sleep < int(config['settings']['timeout']):
-    sleep += 1
-  if sleep >= int(config['settings']['timeout']):
-    if screenMode == 0 or screenMode == 2: # Only sleep on the Clock or Now Playing screens
-      backlight.off()
-  time.sleep(1)
+# Startup is staged to get the clock up as soon as possible: the display,
+# config and backlight, then the first frame (the clock needs no icons),
+# then the icons and caches.  Last.fm and Pushbullet are then set up in
+# parallel in the background, which is where the network libraries are
+# first imported.  Each stage is timed and the times logged when all are
+# done.
+
+if __name__ == '__main__':
+  # With --bench, run the benchmarks on the Headless backend and exit,
+  # failing if any scenario drew nothing.  With --fb (or --fb=<device or
+  # file>), draw straight to the framebuffer.
+  if '--bench' in sys.argv:
+    log("Benchmarking...", "INFO")
+    benchmark = HeadlessBenchmark()
+    benchmark.run()
+    benchmark.report()
+    benchmark.config.flush() # Settings the scenarios changed, rather than on a timer
+    sys.exit(1 if benchmark.check() else 0)
+  fbdev   = [arg.partition('=')[2] or "/dev/fb1" for arg in sys.argv
+             if arg == '--fb' or arg.startswith('--fb=')]
+  if fbdev:
+    backend = Framebuffer(fbdev[-1])
+  else:
+    backend = PiTFT()
+  startup = StartupTimer()
+
+  # Init pygame and screen
+  screen   = backend.open()
+  renderer = Renderer(screen, [NotificationPanel()], backend.update)
+  startup.mark("display")
+
+  # Check config
+  if os.path.isfile('config.json'):
+    with open('config.json') as infile:
+      config = ConfigStore('config.json', json.load(infile))
+  else:
+    config = ConfigStore('config.json', CreateConfig())
+    config.flush(True)
+  atexit.register(config.flush)
+  startup.mark("config")
+
+  # Set the second tact switch up
+  backend.buttons(TFTBtn2Click)
+
+  # Init the Backlight class and the app's state
+  backlight = backend.backlight(config)
+  app = AppState(time.time(), backlight, notices, config, hitGrids,
+                 config.get('settings', 'overlay', 7, int))
+
+  # Handle input on the main thread, only waking for the events we use
+  pygame.event.set_blocked(None)
+  dispatcher = InputDispatcher()
+  dispatcher.on(MOUSEBUTTONDOWN, OnTap)
+  dispatcher.on(TFTBUTTONCLICK,  OnTFTButton)
+  dispatcher.on(TIMEREVENT,      None)
+  dispatcher.on(WAKEEVENT,       None)
+  dispatcher.on(QUIT,            OnQuit)
+  scheduler = Scheduler(TIMEREVENT)
+  power     = DisplayPower(backlight)
+  startup.mark("backlight")
+
+  # Show the clock
+  app.apply(TickEvent(time.time()))
+  renderer.render(scenes[app.mode])
+  scheduler.at('backlight', app.sleepAt)
+  scheduler.at('frame', renderer.due(app.now))
+  startup.frame()
+  startup.mark("first frame")
+
+  loadIcons()
+  startup.mark("icons")
+
+  # Start fetching covers, and open the notification history with whatever
+  # was logged before a restart
+  covers.start()
+  notificationLog = NotificationLog("cache/notifications.ring")
+  startup.mark("caches")
+
+  # Export metrics, and profile on SIGUSR1
+  exporter = MetricsExporter(metrics, config.get('settings', 'metrics', "/run/screen/metrics.prom"))
+  exporter.start()
+  profiler = SamplingProfiler()
+  if hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, profiler.start)
+
+  # Connect to Last.fm and Pushbullet
+  startup.background("Last.fm",    StartLastfm)
+  startup.background("Pushbullet", StartPushbullet)
+  startup.done()
+
+  # Main loop --------------------------------------------------------------
+  log("Begin.", "INFO")
+  while(True):
+    # Block until there's input, something new to show or a deadline
+    scheduler.wait(dispatcher)
+
+    # Apply whatever the background threads have sent, then bring the
+    # state up to date
+    while not events.empty():
+      app.apply(events.get())
+    app.apply(TickEvent(time.time()))
+    if app.shown and pbStream:
+      pbStream.displayed(app.shown)
+    scheduler.at('overlay', app.noticeExpires if app.notice else None)
+    scheduler.at('backlight', app.sleepAt)
+
+    # Redraw whatever changed in the current screen mode; nothing is drawn
+    # while the display is asleep
+    if power.update():
+      renderer.render(scenes[app.mode])
+      dispatcher.rendered()
+      power.rendered()
+      scheduler.at('frame', renderer.due(app.now))
+    else:
+      scheduler.at('frame', None)
@@ -0,0 +1,20 @@
+# Shared setup for the tests: screen.py is imported from the directory
+# above, and pygame runs on SDL's dummy drivers so no display is needed.
+
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import pygame
+import pytest
+
+@pytest.fixture
+def display():
+  pygame.display.init()
+  pygame.display.set_mode((320, 240), 0, 16) # As the PiTFT
+  yield
+  pygame.display.quit()
@@ -0,0 +1,85 @@
+# Backlight driving a FakeSysfs tree: the GPIO switch, skipped no-op
+# writes, and the opt-in PWM device with its fade.
+
+import time
+
+import pytest
+
+import screen
+
+@pytest.fixture
+def sysfs(tmpdir):
+  return screen.FakeSysfs(str(tmpdir.join('sys')), pwm=True, max_brightness=200)
+
+def settings(tmpdir, **values):
+  settings = {'backlight': "on"}
+  settings.update(values)
+  return screen.ConfigStore(str(tmpdir.join('config.json')), {'settings': settings})
+
+def read(sysfs, path):
+  with open('%s/%s' % (sysfs, path)) as infile:
+    return infile.read()
+
+def test_gpio_skips_writes_in_the_same_state(tmpdir, sysfs):
+  backlight = screen.Backlight(settings(tmpdir), sysfs)
+  switches  = backlight.switches.value()
+  assert read(sysfs, 'gpio/gpio508/direction') == 'out'
+  assert read(sysfs, 'gpio/gpio508/value') == '1'
+  backlight.on()
+  assert backlight.switches.value() == switches
+  backlight.off()
+  backlight.off()
+  assert read(sysfs, 'gpio/gpio508/value') == '0'
+  assert backlight.switches.value() == switches + 1
+  assert backlight.config.get('settings', 'backlight') == "off"
+
+@pytest.mark.parametrize('device', [None, "missing"])
+def test_pwm_is_opt_in(tmpdir, sysfs, device):
+  backlight = screen.Backlight(settings(tmpdir, backlight_device=device), sysfs)
+  assert not backlight.pwm
+  assert read(sysfs, 'gpio/gpio508/value') == '1'
+  assert read(sysfs, 'backlight/fake/brightness') == '0' # Left alone
+
+# Every value the Backlight writes, in order
+def recorded(backlight):
+  writes = []
+  write  = backlight.write
+  def record(value):
+    writes.append(value)
+    write(value)
+  backlight.write = record
+  return writes
+
+def wait(condition, timeout=5):
+  deadline = time.time() + timeout
+  while not condition():
+    assert time.time() < deadline, "timed out"
+    time.sleep(0.01)
+
+def test_pwm_fades_to_the_brightness_setting(tmpdir, sysfs):
+  config    = settings(tmpdir, backlight_device="fake", brightness=50)
+  backlight = screen.Backlight(config, sysfs, fade=0.2)
+  assert backlight.pwm
+  assert read(sysfs, 'backlight/fake/brightness') == '100' # Straight on at startup
+  assert read(sysfs, 'gpio/gpio508/value') == '' # GPIO untouched
+  writes = recorded(backlight)
+  backlight.off()
+  wait(lambda: writes[-1:] == [0])
+  assert writes == list(range(90, -1, -10))
+  assert read(sysfs, 'backlight/fake/brightness') == '0'
+
+def test_switching_again_cancels_a_fade(tmpdir, sysfs):
+  config    = settings(tmpdir, backlight_device="fake")
+  backlight = screen.Backlight(config, sysfs, fade=1)
+  switches  = backlight.switches.value()
+  writes    = recorded(backlight)
+  backlight.off()
+  wait(lambda: writes)
+  backlight.on()
+  wait(lambda: writes[-1:] == [200])
+  time.sleep(0.2) # The off fade would have written again by now
+  down = writes.index(min(writes))
+  assert writes[:down + 1] == sorted(writes[:down + 1], reverse=True)
+  assert writes[down:] == sorted(writes[down:]) and writes[-1] == 200
+  assert 0 < min(writes) and read(sysfs, 'backlight/fake/brightness') == '200'
+  assert backlight.switches.value() == switches + 2
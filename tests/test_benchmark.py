@@ -0,0 +1,55 @@
+# The benchmarks, run on the Headless backend as a check that every
+# scenario still draws.
+
+import time
+
+import conftest
+
+import screen
+
+def test_every_scenario_draws(tmpdir, monkeypatch):
+  monkeypatch.chdir(conftest.root) # For the icons and fonts
+  benchmark = screen.HeadlessBenchmark(str(tmpdir))
+  results   = benchmark.run()
+
+  assert benchmark.check() == []
+  assert list(results) == [(name, mode) for name, modes in benchmark.expected.items()
+                           for mode in modes]
+  for frames in results.values():
+    assert all(ms >= 0 and pixels >= 0 for ms, objects, pixels in frames)
+  assert list(benchmark.steps) == ["plain scale", "process", "area scale",
+                                   "dither", "backdrop", "blit cover"]
+  assert list(benchmark.hits) == ["hit grid", "linear scan"]
+  cover = screen.covers.get(benchmark.cover(0))
+  assert tuple(cover.get_at((57, 57)))[:3] != (0, 0, 0) # Drawn in colour
+  benchmark.config.flush()
+
+def test_check_reports_scenarios_that_draw_nothing(tmpdir, monkeypatch):
+  monkeypatch.chdir(conftest.root)
+  benchmark = screen.HeadlessBenchmark(str(tmpdir))
+  benchmark.scenario("tact switch", lambda now: None, [0])
+  assert benchmark.check() == [("tact switch", 0)]
+
+def test_backdrop_is_drawn_under_the_buttons(tmpdir, monkeypatch):
+  monkeypatch.chdir(conftest.root)
+  benchmark = screen.HeadlessBenchmark(str(tmpdir))
+  url = benchmark.cover(0)
+  def nowPlaying(now):
+    screen.app.apply(screen.NowPlayingEvent(now, screen.NowPlaying("Artist", "Album", "Title", url)))
+    benchmark.frame(now)
+    deadline = time.time() + 10
+    while screen.covers.backdrop(url) is None and time.time() < deadline:
+      time.sleep(0.01)
+    benchmark.frame(now + 1)
+  benchmark.scenario("backdrop", nowPlaying, [2])
+  backdrop = screen.covers.backdrop(url)
+  assert backdrop is not None and screen.scenes[2].key[0] == (url, backdrop)
+
+  cog   = screen.buttons[2][1]
+  icon  = cog.iconBg.bitmap
+  drawn = benchmark.renderer.screen
+  solid = [(x, y) for x in range(icon.get_width()) for y in range(icon.get_height())
+           if icon.get_at((x, y)).a > 200]
+  assert solid
+  assert all(drawn.get_at((cog.rect.x + x, cog.rect.y + y)) !=
+             backdrop.get_at((cog.rect.x + x, cog.rect.y + y)) for x, y in solid)
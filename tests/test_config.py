@@ -0,0 +1,30 @@
+# ConfigStore's debounced saves, and saving them on SIGTERM.
+
+import json
+import os
+import signal
+import threading
+
+import pygame
+import pytest
+
+import screen
+
+def test_quit_saves_pending_changes(tmpdir):
+  path = str(tmpdir.join('config.json'))
+  screen.config = screen.ConfigStore(path, {'settings': {'timeout': 9}}, window=60)
+  screen.config.set('settings', 'timeout', 30)
+  assert not os.path.exists(path) # Still waiting on the timer
+  with pytest.raises(SystemExit):
+    screen.OnQuit(None)
+  with open(path) as infile:
+    assert json.load(infile)['settings']['timeout'] == 30
+
+def test_sigterm_wakes_the_main_loop(display):
+  pygame.event.set_blocked(None)
+  dispatcher = screen.InputDispatcher()
+  quits      = []
+  dispatcher.on(pygame.QUIT, quits.append)
+  threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+  dispatcher.wait()
+  assert len(quits) == 1
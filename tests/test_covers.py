@@ -0,0 +1,74 @@
+# CoverFetcher downloading covers from a local HTTP server: only images
+# reach the disk cache, and a stalled download times out.
+
+import BaseHTTPServer
+import os
+import threading
+import time
+
+import pygame
+import pytest
+
+import screen
+
+# Serves /cover.png as a PNG and anything else as a 404; /stall doesn't
+# answer for a few seconds
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path == '/stall':
+      time.sleep(3)
+    if self.path != '/cover.png':
+      return self.send_error(404, "not found")
+    with open(self.server.png, 'rb') as infile:
+      data = infile.read()
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/png')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def server(display, tmpdir):
+  server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+  server.png = str(tmpdir.join('cover.png'))
+  bitmap = pygame.Surface((300, 300))
+  bitmap.fill((200, 120, 60))
+  pygame.image.save(bitmap, server.png)
+  server.url = "http://127.0.0.1:%d/" % server.server_address[1]
+  thread = threading.Thread(target=server.serve_forever)
+  thread.setDaemon(True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def test_only_images_are_cached(server, tmpdir):
+  fetcher = screen.CoverFetcher(str(tmpdir.join('covers')))
+  with pytest.raises(Exception):
+    fetcher.load(server.url + 'missing.png')
+  assert os.listdir(fetcher.path) == []
+  cover, backdrop = fetcher.load(server.url + 'cover.png')
+  assert tuple(cover.get_at((57, 57)))[:3] != (0, 0, 0)
+  assert len(os.listdir(fetcher.path)) == 1
+
+def test_a_broken_cached_file_is_fetched_again(server, tmpdir):
+  fetcher = screen.CoverFetcher(str(tmpdir.join('covers')))
+  url     = server.url + 'cover.png'
+  fetcher.load(url)
+  name = os.listdir(fetcher.path)[0]
+  with open(os.path.join(fetcher.path, name), 'wb') as outfile:
+    outfile.write("<html>not found</html>")
+  with pytest.raises(pygame.error):
+    fetcher.load(url)
+  assert os.listdir(fetcher.path) == []
+  assert fetcher.load(url) is not None
+
+def test_stalled_downloads_time_out(server, tmpdir):
+  fetcher = screen.CoverFetcher(str(tmpdir.join('covers')), timeout=0.5)
+  start   = time.time()
+  with pytest.raises(Exception):
+    fetcher.load(server.url + 'stall')
+  assert time.time() - start < 2
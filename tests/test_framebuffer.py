@@ -0,0 +1,52 @@
+# The Framebuffer backend drawing into a plain file standing in for
+# /dev/fb1.
+
+import struct
+
+import pygame
+import pytest
+
+import screen
+
+@pytest.fixture
+def framebuffer(tmpdir):
+  path = tmpdir.join('fb1')
+  path.write('\0' * 320 * 240 * 2)
+  fb = screen.Framebuffer(str(path), touchscreen=None)
+  fb.open()
+  yield fb
+  pygame.display.quit()
+
+def pixel(fb, x, y):
+  return struct.unpack_from('<H', fb.map, y * fb.stride + x * 2)[0]
+
+@pytest.mark.parametrize('direct', [True, False])
+def test_dirty_rects_reach_the_file(framebuffer, direct):
+  fb = framebuffer
+  assert fb.map is not None and fb.size == (320, 240) and fb.stride == 640
+  fb.direct = fb.direct and direct # False: as on pygame before 1.9.2
+  fb.surface.fill((255, 0, 0), (10, 20, 30, 40))
+  fb.surface.fill((0, 0, 255), (0, 100, 320, 10))
+  fb.update([pygame.Rect(10, 20, 30, 40), pygame.Rect(0, 100, 320, 10)])
+  assert pixel(fb, 10, 20) == 0xF800 and pixel(fb, 39, 59) == 0xF800
+  assert pixel(fb, 9, 20) == 0 and pixel(fb, 40, 20) == 0
+  assert pixel(fb, 0, 100) == 0x001F and pixel(fb, 319, 109) == 0x001F
+  assert pixel(fb, 0, 110) == 0
+
+def test_missing_device_falls_back_to_sdl(tmpdir, monkeypatch):
+  fb = screen.Framebuffer(str(tmpdir.join('missing')), touchscreen=None)
+  opened = []
+  monkeypatch.setattr(fb.sdl, 'open', lambda: opened.append(True))
+  fb.open()
+  assert opened and fb.map is None
+
+def test_covers_are_processed_in_colour(framebuffer):
+  assert pygame.display.get_surface().get_bitsize() == 16
+  bitmap = pygame.Surface((300, 300))
+  bitmap.fill((200, 120, 60))
+  cover, backdrop = screen.covers.process(bitmap)
+  framebuffer.surface.blit(cover, (19, 48))
+  framebuffer.update([pygame.Rect(19, 48, 115, 115)])
+  assert tuple(cover.get_at((57, 57)))[:3] != (0, 0, 0)
+  assert pixel(framebuffer, 76, 105) != 0
+  assert tuple(backdrop.get_at((160, 120)))[:3] != (0, 0, 0)
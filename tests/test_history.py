@@ -0,0 +1,79 @@
+# ScrobbleHistory syncing from a stand-in Last.fm user: the first run's
+# backfill, then only what's newer than the newest scrobble stored.
+
+import collections
+
+import pytest
+
+import screen
+
+START = 1500000000
+
+# Like pylast's PlayedTrack, and the Track and Artist in it
+PlayedTrack = collections.namedtuple('PlayedTrack', 'track album playback_date timestamp')
+
+class Artist:
+  def __init__(self, name):
+    self.name = name
+
+  def get_name(self):
+    return self.name
+
+class Track:
+  def __init__(self, artist, title):
+    self.artist = Artist(artist)
+    self.title  = title
+
+  def get_title(self):
+    return self.title
+
+def played(t, title, album="Album"):
+  return PlayedTrack(Track("Artist", title), album, "", str(t))
+
+# Answers get_recent_tracks from scrobbles as Last.fm would, newest first,
+# and keeps the arguments of every call
+class User:
+  def __init__(self):
+    self.scrobbles = []
+    self.calls     = []
+
+  def get_recent_tracks(self, limit=10, cacheable=True, time_from=None):
+    self.calls.append({'limit': limit, 'time_from': time_from})
+    tracks = [p for p in sorted(self.scrobbles, key=lambda p: -int(p.timestamp))
+              if time_from is None or int(p.timestamp) >= time_from]
+    return tracks[:limit] if limit else tracks
+
+@pytest.fixture
+def history(display, tmpdir):
+  while not screen.events.empty():
+    screen.events.get()
+  return screen.ScrobbleHistory(str(tmpdir.join('history.db')), User(), backfill=3)
+
+def test_first_sync_backfills(history):
+  history.user.scrobbles = [played(START + i, "Track %d" % i) for i in range(5)]
+  assert history.sync() == 3
+  assert history.user.calls == [{'limit': 3, 'time_from': None}]
+  assert [s.title for s in history.page(0, 10)] == ["Track 4", "Track 3", "Track 2"]
+  assert history.version == 1
+  event = screen.events.get_nowait()
+  assert isinstance(event, screen.HistoryEvent) and event.version == 1
+
+def test_later_syncs_ask_only_for_newer_scrobbles(history):
+  history.user.scrobbles = [played(START, "Old", album=None)]
+  history.sync()
+  history.user.scrobbles += [played(START + 60, "New"), played(START + 120, "Newer")]
+  assert history.sync() == 2
+  assert history.user.calls[-1] == {'limit': None, 'time_from': START + 1}
+  assert history.count() == 3 and history.newest() == START + 120
+  assert history.page(2, 1)[0].album == "" # No album stored as empty
+  assert history.version == 2
+
+def test_sync_counts_only_rows_added(history):
+  history.user.scrobbles = [played(START, "Track")]
+  history.sync()
+  history.user.get_recent_tracks = lambda **kwargs: [played(START, "Track")]
+  assert history.sync() == 0 # Already stored
+  history.user.get_recent_tracks = lambda **kwargs: []
+  assert history.sync() == 0
+  assert history.version == 1 and history.plays("Artist", "Track") == 1
+  assert screen.events.qsize() == 1 # Posted by the first sync only
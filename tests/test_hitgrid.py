@@ -0,0 +1,41 @@
+# HitGrid against the linear first-match scan it replaced, on every
+# screen's buttons.
+
+import random
+
+import pytest
+
+import screen
+
+def scan(buttons, pos):
+  for b in buttons:
+    if b.contains(pos):
+      return b
+  return None
+
+# Random points on and off the screen, and every Button's corners and
+# the points just outside them
+def points(buttons, n=2000):
+  rng    = random.Random(7)
+  points = [(rng.randrange(-40, 360), rng.randrange(-40, 280)) for i in range(n)]
+  points += [(x, y) for x in (-1, 0, 319, 320) for y in (-1, 0, 239, 240)]
+  for b in buttons:
+    for x in (b.rect.left - 1, b.rect.left, b.rect.right - 1, b.rect.right):
+      for y in (b.rect.top - 1, b.rect.top, b.rect.bottom - 1, b.rect.bottom):
+        points.append((x, y))
+  return points
+
+@pytest.mark.parametrize('mode', range(len(screen.buttons)))
+def test_hit_matches_a_linear_scan(mode):
+  buttons = screen.buttons[mode]
+  grid    = screen.HitGrid(buttons)
+  for pos in points(buttons):
+    assert grid.hit(pos) is scan(buttons, pos), pos
+
+def test_overlapping_buttons_keep_their_order():
+  first, second = screen.Button((10, 10, 100, 100)), screen.Button((50, 50, 100, 100))
+  grid = screen.HitGrid([first, second], cell=40)
+  assert grid.hit((60, 60)) is first
+  assert grid.hit((120, 120)) is second
+  grid.rebuild([second, first])
+  assert grid.hit((60, 60)) is second
@@ -0,0 +1,27 @@
+# The Metrics registry's export, and the counters registered with it.
+
+import pygame
+
+import screen
+
+def test_text_cache_counts_are_exported(display):
+  cache = screen.TextCache(limit=1)
+  font  = pygame.font.Font(None, 20)
+  hits, misses, evictions = cache.hits.value(), cache.misses.value(), cache.evictions.value()
+  cache.render(font, "one")
+  cache.render(font, "one")
+  cache.render(font, "two") # Over the limit, so "one" goes
+  assert cache.hits.value() - hits == 1
+  assert cache.misses.value() - misses == 2
+  assert cache.evictions.value() - evictions == 1
+  text = screen.metrics.text()
+  for name in ('text_cache_hits_total', 'text_cache_misses_total',
+               'text_cache_evictions_total', 'notifications_dropped_total'):
+    assert "\nscreen_%s " % name in text
+
+def test_exporter_writes_to_tmpfs_by_default(tmpdir):
+  exporter = screen.MetricsExporter(screen.metrics)
+  assert exporter.path.startswith('/run/')
+  exporter.path = str(tmpdir.join('metrics', 'screen.prom'))
+  exporter.write()
+  assert "# TYPE screen_text_cache_hits_total counter" in tmpdir.join('metrics', 'screen.prom').read()
@@ -0,0 +1,47 @@
+# NotificationLog's ring file: fitting real pushes into a slot, and
+# reopening a file with a torn slot.
+
+import json
+
+import screen
+
+# A push as the API returns it, with all its bookkeeping fields
+def push(iden, body):
+  return {'iden': iden, 'type': 'note', 'active': True, 'dismissed': False,
+          'created': 1500000000.123456, 'modified': 1500000001.654321,
+          'direction': 'incoming', 'sender_iden': 'u' * 22,
+          'sender_email': 'someone@example.com', 'sender_email_normalized': 'someone@example.com',
+          'sender_name': 'Some One', 'receiver_iden': 'u' * 22,
+          'receiver_email': 'me@example.com', 'receiver_email_normalized': 'me@example.com',
+          'source_device_iden': 'd' * 22, 'target_device_iden': 't' * 22,
+          'guid': 'g' * 36, 'title': "A title " * 20, 'body': body}
+
+def test_long_pushes_fit_a_slot(tmpdir):
+  log = screen.NotificationLog(str(tmpdir.join('ring')), slots=4, slot=512)
+  assert log.append("push", push('long', "Body " * 200), 'phone')
+  record = log.page(0, 1)[0]
+  assert record.data['iden'] == 'long'
+  assert record.data['body'].startswith("Body Body")
+  assert 'created' not in record.data and 'guid' not in record.data
+
+def test_pack_always_fits(tmpdir):
+  log = screen.NotificationLog(str(tmpdir.join('ring')), slots=4, slot=64)
+  room = log.slot - log.RECORD.size
+  for source in ('phone', 'x' * 1000):
+    text = log.pack("push", {'title': u"\xe9" * 300, 'iden': 'i' * 100}, source)
+    assert len(text) <= room
+
+def test_torn_slot_reads_as_empty(tmpdir):
+  path = str(tmpdir.join('ring'))
+  log  = screen.NotificationLog(path, slots=4, slot=128)
+  for i in range(3):
+    log.append("push", {'type': 'note', 'iden': 'p%d' % i, 'title': "Push %d" % i},
+               'phone', 1500000000 + i)
+  offset = log.HEADER.size + 1 * log.slot + log.RECORD.size
+  log.map[offset:offset + 8] = '{"kind":' # Torn: the JSON is cut short
+  log.map.flush()
+
+  log = screen.NotificationLog(path, slots=4, slot=128)
+  assert [n.data['iden'] for n in log.page(0, 4) if n] == ['p2', 'p0']
+  assert log.count() == 2
+  assert log.append("push", {'type': 'note', 'iden': 'p3'}, 'phone')
@@ -0,0 +1,33 @@
+# NotificationQueue coalescing bursts, dropping only when full, and
+# reporting both as metrics.
+
+import screen
+
+START = 1500000000
+
+def test_burst_from_many_devices_is_shown_once():
+  queue     = screen.NotificationQueue()
+  coalesced = screen.metrics.counter('notifications_coalesced_total', "")
+  before    = coalesced.value()
+  for i in range(20):
+    queue.put("push", {'title': "Push %d" % i}, "device%d" % i, START + i * 0.05)
+  assert len(queue) == 1
+  notification = queue.get()
+  assert notification.count == 20 and notification.data['title'] == "Push 19"
+  assert coalesced.value() - before == 19
+
+def test_full_queue_drops_the_oldest():
+  queue   = screen.NotificationQueue(maxlen=3, window=2)
+  dropped = screen.metrics.counter('notifications_dropped_total', "")
+  before  = dropped.value()
+  for i in range(5): # Too far apart to coalesce
+    queue.put("push", {'title': "Push %d" % i}, "phone", START + i * 10)
+  assert dropped.value() - before == 2
+  assert [queue.get().data['title'] for i in range(3)] == ["Push 2", "Push 3", "Push 4"]
+  assert queue.get() is None
+
+def test_queue_is_exported():
+  text = screen.metrics.text()
+  for name in ('notification_queue_length', 'notifications_dropped_total',
+               'notifications_coalesced_total'):
+    assert "\nscreen_%s " % name in text
@@ -0,0 +1,186 @@
+# PushbulletStream and the push handlers against StandIn, a local stand-in
+# for Pushbullet's websocket stream and the parts of its REST API they use.
+
+import SocketServer
+import base64
+import hashlib
+import json
+import threading
+import time
+import urlparse
+
+import pytest
+
+import screen
+
+# StandIn serves the websocket stream (any request asking to upgrade) and
+# /v2/pushes and /v2/devices on one port.  Upgrades are turned away while
+# refuse is above zero; attempts holds the time of every upgrade request.
+# pushes are served to modified_after queries, each response held back
+# fetchDelay seconds, and fetched holds when each was sent.  send() sends
+# a message to every open stream.
+
+class StandIn(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+  def __init__(self):
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+    self.url        = "http://127.0.0.1:%d/v2/" % self.server_address[1]
+    self.stream     = "ws://127.0.0.1:%d/websocket/key" % self.server_address[1]
+    self.refuse     = 0
+    self.attempts   = []
+    self.pushes     = []
+    self.fetchDelay = 0
+    self.fetched    = []
+    self.sockets    = []
+    self.lock       = threading.Lock()
+    thread = threading.Thread(target=self.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def send(self, message):
+    text = json.dumps(message)
+    with self.lock:
+      for sock in self.sockets:
+        sock.sendall('\x81' + chr(len(text)) + text)
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+    with self.lock:
+      for sock in self.sockets:
+        sock.close()
+
+class StandInHandler(SocketServer.StreamRequestHandler):
+  GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+  def handle(self):
+    path    = self.rfile.readline().split()[1]
+    headers = {}
+    for line in iter(self.rfile.readline, '\r\n'):
+      name, _, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+    if headers.get('upgrade', '').lower() == 'websocket':
+      self.stream(headers['sec-websocket-key'])
+    else:
+      self.rest(path)
+
+  def stream(self, key):
+    server = self.server
+    server.attempts.append(time.time())
+    if server.refuse > 0:
+      server.refuse -= 1
+      self.wfile.write("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+      return
+    accept = base64.b64encode(hashlib.sha1(key + self.GUID).digest())
+    self.wfile.write("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                     "Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept)
+    self.wfile.flush()
+    with server.lock:
+      server.sockets.append(self.connection)
+    try:
+      while True: # Until the client closes (or the connection drops)
+        data = self.connection.recv(1024)
+        if not data or ord(data[0]) & 0x0f == 8:
+          break
+      self.connection.sendall('\x88\x00')
+    except EnvironmentError:
+      pass
+    finally:
+      with server.lock:
+        server.sockets.remove(self.connection)
+
+  def rest(self, path):
+    url   = urlparse.urlparse(path)
+    query = urlparse.parse_qs(url.query)
+    if url.path.endswith('/pushes'):
+      since = float(query['modified_after'][0])
+      time.sleep(self.server.fetchDelay)
+      body  = {'pushes': sorted([p for p in self.server.pushes if p['modified'] > since],
+                                key=lambda p: -p['modified'])}
+      self.server.fetched.append(time.time())
+    else:
+      body  = {'devices': []}
+    text = json.dumps(body)
+    self.wfile.write("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     "Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(text), text))
+
+def wait(condition, timeout=10):
+  deadline = time.time() + timeout
+  while not condition():
+    assert time.time() < deadline, "timed out"
+    time.sleep(0.01)
+
+@pytest.fixture
+def standin(display, tmpdir):
+  server = StandIn()
+  screen.config          = screen.ConfigStore(str(tmpdir.join('config.json')),
+                                              {'pushbullet': {'mirroring': "on"}})
+  screen.notificationLog = screen.NotificationLog(str(tmpdir.join('notifications.ring')))
+  screen.pushbullet      = screen.PushbulletAPI('key', server.url)
+  while not screen.events.empty():
+    screen.events.get()
+  yield server
+  server.stop()
+
+def stream(server, **kwargs):
+  screen.pbStream = screen.PushbulletStream(server.stream, screen.OnPBMessage,
+                                            screen.OnPBStart, **kwargs)
+  screen.pbStream.start()
+  return screen.pbStream
+
+def push(iden, title):
+  return {'iden': iden, 'type': 'note', 'title': title, 'active': True,
+          'modified': time.time(), 'created': time.time()}
+
+def test_heartbeat_timeout_reconnects_and_catches_up(standin):
+  pb = stream(standin, timeout=0.6, minDelay=0.1, maxDelay=0.4)
+  wait(lambda: pb.connected)
+  for i in range(5): # Heartbeats keep the connection up
+    silent = time.time()
+    standin.send({'type': 'nop'})
+    time.sleep(0.2)
+  assert pb.reconnects == 0 and pb.connected
+
+  # Sent while the heartbeats have stopped; only seen by catching up
+  standin.pushes.append(push('missed', "Sent while away"))
+  wait(lambda: pb.reconnects == 1 and pb.connected)
+  assert pb.connected - silent >= pb.timeout # Timed from the last heartbeat
+  event = screen.events.get(timeout=5)
+  assert isinstance(event, screen.NoticeEvent)
+  assert event.data['iden'] == 'missed'
+  assert event.time == pb.connected
+
+def test_reconnect_backs_off(standin):
+  standin.refuse = 4
+  pb = stream(standin, timeout=5, minDelay=0.1, maxDelay=0.4)
+  wait(lambda: pb.connected)
+  assert pb.reconnects == 4
+  gaps = [b - a for a, b in zip(standin.attempts, standin.attempts[1:])]
+  # Each delay is jittered by 20%: 0.1, 0.2, 0.4, then capped at 0.4
+  assert 0.08 <= gaps[0] < 0.16 <= gaps[1] < 0.32 <= gaps[2]
+  assert 0.32 <= gaps[3] < 0.55
+
+def test_tickle_latency_includes_fetch(standin):
+  pb = stream(standin)
+  wait(lambda: pb.connected)
+  standin.fetchDelay = 0.3
+  standin.pushes.append(push('new', "Hello"))
+  standin.send({'type': 'tickle', 'subtype': 'push'})
+  event = screen.events.get(timeout=5)
+  assert event.data['iden'] == 'new'
+  assert standin.fetched[-1] - event.time >= 0.3 # Timed from the tickle arriving
+  count, total = pb.latency.count, pb.latency.sum
+  pb.displayed(screen.Notification(event.kind, event.data, event.source, event.time, 1))
+  assert pb.latency.count == count + 1 and pb.latency.sum - total >= 300
+
+def test_ephemeral_pushes_are_not_shown(standin):
+  pb = stream(standin)
+  wait(lambda: pb.connected)
+  standin.send({'type': 'push', 'push': {'type': 'dismissal', 'package_name': 'app'}})
+  standin.send({'type': 'push', 'push': {'type': 'mirror', 'package_name': 'app',
+                                         'title': "Mirrored", 'icon': ''}})
+  event = screen.events.get(timeout=5)
+  assert event.kind == "mirror" and event.data['title'] == "Mirrored"
+  assert screen.events.empty()
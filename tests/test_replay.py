@@ -0,0 +1,65 @@
+# Replaying recorded events through a fresh AppState, with its own config
+# and a Backlight on a FakeSysfs tree.
+
+import pytest
+
+import screen
+
+START = 1500000000 # On a minute boundary
+
+@pytest.fixture
+def replay(tmpdir):
+  config = screen.ConfigStore(str(tmpdir.join('config.json')), {
+    'pushbullet': {'mirroring': "off"},
+    'settings':   {'backlight': "on", 'timeout': 9, 'overlay': 7}})
+  backlight = screen.Backlight(config, screen.FakeSysfs(str(tmpdir.join('sys'))))
+  def replay(events):
+    return screen.Replay(events, backlight, config, duration=7)
+  yield replay
+  config.flush() # Before tmpdir goes, rather than on the timer
+
+def test_replay_settings_track_and_notice(replay):
+  push   = {'type': 'note', 'title': "Hello", 'body': "From the replay"}
+  events = [
+    screen.TickEvent(START),
+    screen.TapEvent(START + 1, (160, 120)),      # Clock -> Settings
+    screen.TapEvent(START + 2, (290, 90)),       # Timeout -> keypad
+    screen.TapEvent(START + 3, (270, 150)),      # Delete the 9
+    screen.TapEvent(START + 4, (30, 210)),       # 1
+    screen.TapEvent(START + 5, (210, 150)),      # 0
+    screen.TapEvent(START + 6, (250, 210)),      # OK -> Settings
+    screen.TapEvent(START + 7, (80, 210)),       # OK -> Clock
+    screen.TickEvent(START + 7),
+    screen.NowPlayingEvent(START + 8, screen.NowPlaying("Artist", "Album", "Title", False)),
+    screen.TickEvent(START + 8),
+    screen.NoticeEvent(START + 9, "push", push, "phone"),
+    screen.TickEvent(START + 9),
+    screen.TapEvent(START + 10, (160, 210)),     # Cog -> Scrobble history
+    screen.TickEvent(START + 10)]
+  app, trace = replay(events)
+
+  assert [mode for t, mode, notice in trace] == [0, 1, 5, 5, 5, 5, 1, 0, 0, 0, 2, 2, 2, 3, 3]
+  assert app.config.get('settings', 'timeout') == 10
+  assert app.track.title == "Title"
+  assert app.mode == 3
+  assert app.notice.data == push and app.noticeExpires == START + 16
+  assert app.backlight.state
+
+def test_replay_notice_expires_and_backlight_times_out(replay):
+  events = [screen.TickEvent(START),
+            screen.NoticeEvent(START + 1, "push", {'type': 'note', 'title': "Hi"}, "phone"),
+            screen.TickEvent(START + 1)]
+  events += [screen.TickEvent(START + t) for t in range(2, 20)]
+  app, trace = replay(events)
+
+  shown = [t for t, mode, notice in trace if notice]
+  assert shown == list(range(START + 1, START + 8))
+  assert app.notice is None and app.mode == 0
+  # Asleep 9 seconds after the notification was last on screen
+  assert not app.backlight.state
+  assert app.config.get('settings', 'backlight') == "off"
+
+def test_replay_leaves_the_app_alone(replay):
+  screen.app = None
+  replay([screen.TickEvent(START)])
+  assert screen.app is None